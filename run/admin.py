@@ -1,16 +1,28 @@
-from run.models import Run, Shoe, UserProfile
+from run.models import Run, Shoe, UserProfile, ImportJob, RecalcJob
 from django.contrib import admin
 
 
 class RunAdmin(admin.ModelAdmin):
     fieldsets = [(None, {'fields': ['user', 'date', 'shoe', 'distance']}), 
                  ('Duration', 
-                    {'fields': ['duration']}),
+                    {'fields': ['seconds']}),
                  ('Physiology', {'fields': ['average_heart_rate']}), 
                 ]
-    list_display = ['date', 'user', 'distance', 'duration']
+    list_display = ['date', 'user', 'distance', 'duration_as_string']
     list_filter = ['user']
 
 admin.site.register(Run, RunAdmin)
 admin.site.register(Shoe)
-admin.site.register(UserProfile)
\ No newline at end of file
+admin.site.register(UserProfile)
+
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ['created', 'user', 'status', 'parsed', 'inserted', 'failed']
+    list_filter = ['status']
+
+admin.site.register(ImportJob, ImportJobAdmin)
+
+class RecalcJobAdmin(admin.ModelAdmin):
+    list_display = ['created', 'user', 'status', 'changed']
+    list_filter = ['status']
+
+admin.site.register(RecalcJob, RecalcJobAdmin)
@@ -0,0 +1,68 @@
+"""
+Bulk writes that the ORM (as of Django 1.4) can't do in one statement.
+"""
+from django.db import connection, transaction
+from django.db.models.sql import DeleteQuery
+
+# stay under SQLite's default limits on query parameters, and on the
+# SELECTs compounded in a multi-row INSERT
+MAX_PARAMS = 999
+MAX_ROWS = 500
+
+def bulk_create(model, objs):
+    """
+    Inserts objs with as few INSERT statements as the limits allow, which
+    bulk_create (as of Django 1.4) doesn't take into account. Save signals
+    are not sent, and the objects' ids are not set.
+    """
+    batch_size = max(1, min(MAX_ROWS, MAX_PARAMS // len(model._meta.local_fields)))
+    for start in xrange(0, len(objs), batch_size):
+        model.objects.bulk_create(objs[start:start + batch_size])
+
+def bulk_update(model, fields, rows):
+    """
+    Sets the given fields on many rows of model with as few UPDATE statements
+    as the parameter limit allows. rows is a list of (id, values) pairs,
+    values being a tuple in the same order as fields. Save signals are not
+    sent. Returns the number of rows updated.
+    """
+    if not rows:
+        return 0
+
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    pk = qn(model._meta.pk.column)
+    columns = [qn(model._meta.get_field(field).column) for field in fields]
+    batch_size = max(1, MAX_PARAMS // (2 * len(fields) + 1))
+
+    cursor = connection.cursor()
+    for start in xrange(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        params = []
+        assignments = []
+        for (i, column) in enumerate(columns):
+            model_field = model._meta.get_field(fields[i])
+            cases = []
+            for (id, values) in batch:
+                cases.append("WHEN %s THEN %s")
+                params.extend([id, model_field.get_db_prep_save(values[i],
+                    connection=connection)])
+            assignments.append("%s = CASE %s %s END" % (column, pk,
+                " ".join(cases)))
+        params.extend(id for (id, values) in batch)
+        sql = "UPDATE %s SET %s WHERE %s IN (%s)" % (table,
+            ", ".join(assignments), pk, ", ".join(["%s"] * len(batch)))
+        cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+    return len(rows)
+
+def bulk_delete(queryset):
+    """
+    Deletes the rows of queryset by id, without loading them as objects or
+    sending the delete signals (so nothing cascades). Returns the number of
+    rows deleted.
+    """
+    ids = list(queryset.values_list('pk', flat=True))
+    DeleteQuery(queryset.model).delete_batch(ids, queryset.db)
+    transaction.commit_unless_managed()
+    return len(ids)
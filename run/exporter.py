@@ -0,0 +1,202 @@
+"""
+Streaming export of a user's runs. The runs are read with a server-side
+iterator and serialized a chunk of records at a time, so the response can
+start right away and memory use doesn't grow with the history.
+"""
+import csv, json, struct, sys
+from array import array
+from gzip import GzipFile
+from itertools import islice
+from StringIO import StringIO
+
+from django.db import connection
+from django.middleware import gzip
+
+from run.models import Run, Decimal, meters_per_mile, time_to_seconds
+
+CHUNK_RECORDS = 200
+
+EXPORT_FIELDS = ('date', 'seconds', 'distance', 'average_heart_rate', 'calories',
+    'pace')
+
+def export_rows(user):
+    """
+    Yields a tuple of the EXPORT_FIELDS for each of the user's runs, newest
+    first. Runs whose seconds haven't been filled in yet (by set_seconds)
+    take them from their duration.
+    """
+    runs = (Run.objects.filter(user=user.id).order_by('-date')
+        .values_list('duration', *EXPORT_FIELDS))
+    for row in runs.iterator():
+        (duration, day, seconds) = row[:3]
+        if not seconds and duration:
+            seconds = time_to_seconds(duration)
+        yield (day, seconds) + row[3:]
+
+def meters(distance):
+    return int(Decimal(distance) * meters_per_mile)
+
+def record(row):
+    """
+    A run in the format that the web importer reads.
+    """
+    (day, seconds, distance, hr, calories, pace) = row
+    return {'date': str(day),
+        'duration': seconds,
+        'distance': meters(distance),
+        'average_heart_rate': hr,
+        'calories': calories}
+
+def chunks(rows, size=CHUNK_RECORDS):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def json_array(rows):
+    """
+    The runs as one JSON array, byte for byte what json.dumps of the whole
+    list would give.
+    """
+    yield '['
+    separator = ''
+    for chunk in chunks(rows):
+        yield separator + ', '.join(json.dumps(record(row)) for row in chunk)
+        separator = ', '
+    yield ']'
+
+def ndjson(rows):
+    """
+    The runs as newline-delimited JSON, one object per line.
+    """
+    for chunk in chunks(rows):
+        yield ''.join(json.dumps(record(row)) + '\n' for row in chunk)
+
+CSV_HEADER = ('Date', 'Minutes', 'Seconds', 'Distance (mi)', 'Pace',
+    'Heart rate', 'Calories')
+
+def csv_rows(rows):
+    """
+    The runs as CSV in the layout that the import_flotrack command reads
+    (which skips the header line). Distances are in miles, as stored.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf, dialect=csv.excel)
+    writer.writerow(CSV_HEADER)
+    for chunk in chunks(rows):
+        for (day, seconds, distance, hr, calories, pace) in chunk:
+            writer.writerow((day.strftime("%b %d, %Y"), seconds // 60,
+                seconds % 60, distance, pace or '',
+                hr or '', '' if calories is None else calories))
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue() # just the header
+
+# Columnar format: a header of magic, version and number of runs, followed by
+# one packed little-endian array per column. Missing heart rates are 0 and
+# missing calories are -1.
+COLUMNAR_MAGIC = 'RUNC'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<4sBI')
+COLUMNS = (('ordinal', 'i'), ('seconds', 'I'), ('meters', 'I'),
+    ('heart_rate', 'H'), ('calories', 'i'))
+
+def columnar(rows):
+    """
+    The runs as packed columns, 18 bytes per run. Unlike the other formats
+    this can't start until all the runs are read, since each column is
+    written whole.
+    """
+    columns = dict((name, array(typecode)) for (name, typecode) in COLUMNS)
+    for (day, seconds, distance, hr, calories, pace) in rows:
+        columns['ordinal'].append(day.toordinal())
+        columns['seconds'].append(seconds)
+        columns['meters'].append(meters(distance))
+        columns['heart_rate'].append(hr or 0)
+        columns['calories'].append(-1 if calories is None else calories)
+
+    yield COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION,
+        len(columns['ordinal']))
+    for (name, typecode) in COLUMNS:
+        column = columns[name]
+        if sys.byteorder == 'big':
+            column.byteswap()
+        yield column.tostring()
+
+def read_columnar(data):
+    """
+    Parses the columnar format back into a dict of arrays, one per column.
+    """
+    (magic, version, count) = COLUMNAR_HEADER.unpack_from(data)
+    if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+        raise ValueError("Not a version %d columnar run export" %
+            COLUMNAR_VERSION)
+    columns = {}
+    offset = COLUMNAR_HEADER.size
+    for (name, typecode) in COLUMNS:
+        column = array(typecode)
+        size = column.itemsize * count
+        column.fromstring(data[offset:offset + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns[name] = column
+        offset += size
+    return columns
+
+def accepts_gzip(request):
+    return bool(gzip.re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+def gzipped(data):
+    """
+    The chunks of data gzipped as they come, each flushed so that it can be
+    sent right away.
+    """
+    buf = StringIO()
+    zfile = GzipFile(mode='wb', compresslevel=6, fileobj=buf)
+    for chunk in data:
+        zfile.write(chunk)
+        zfile.flush()
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    zfile.close()
+    yield buf.getvalue()
+
+def closing(data):
+    """
+    The chunks of data, then closes the database connection. Django 1.4
+    closes the request's connection (request_finished) before the server
+    iterates over the response, so a streamed export reads with a new
+    connection, outside TransactionMiddleware, that would otherwise stay
+    open (and on PostgreSQL, idle in a transaction) until the thread's
+    next request. This also runs if the client goes away part way, since
+    the server closes the response and with it the generator.
+    """
+    try:
+        for chunk in data:
+            yield chunk
+    finally:
+        connection.close()
+
+class GZipMiddleware(gzip.GZipMiddleware):
+    """
+    Django's GZipMiddleware, except that responses whose content is an
+    iterator are left alone: it would read the whole of the content first,
+    both to measure it and to compress it, so do_export gzips its own.
+    """
+    def process_response(self, request, response):
+        if response._base_content_is_iter:
+            return response
+        return super(GZipMiddleware, self).process_response(request, response)
+
+# format name: (serializer, content type)
+FORMATS = {
+    'json': (json_array, 'application/json'),
+    'ndjson': (ndjson, 'application/x-ndjson'),
+    'csv': (csv_rows, 'text/csv'),
+    'columnar': (columnar, 'application/octet-stream'),
+}
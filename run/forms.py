@@ -1,9 +1,10 @@
-import datetime, logging, json
+import datetime, logging
 from decimal import Decimal
 
 from django.contrib.auth.models import User
 from django.forms import *
-from run.models import UserProfile, Run, Shoe, hms_to_time
+from run.models import UserProfile, Run, Shoe, seconds_to_time
+from run.sources import ImportedRuns
 
 log = logging.getLogger(__name__)
 
@@ -107,31 +108,6 @@ class NewUserForm(ModelForm):
             'is_superuser', 'last_login', 'date_joined', 'groups', 
             'user_permissions']
 
-def obj_to_run(obj):
-    
-    _date = u'date'
-    _duration = u'duration'
-    _average_heart_rate = u'average_heart_rate'
-    _calories = u'calories'
-    _distance = u'distance'
-    
-    run = Run()
-    
-    # try to parse date field
-    run.date = datetime.datetime.strptime(obj[_date], "%Y-%m-%d").date()
-
-    # try to parse the duration and distance fields
-    run.duration = hms_to_time(0,0,int(obj[_duration]))
-    run.distance = float(obj[_distance]) / 1609.344
-
-    # try to parse the HR and calories fields, which may be null
-    if obj[_average_heart_rate]: 
-        run.average_heart_rate = int(obj[_average_heart_rate])
-    if obj[_calories]: 
-        run.calories = int(obj[_calories])
-    return run
-
-
 class RunForm(ModelForm): 
 
     date_month = IntegerField(min_value=1, max_value=12)
@@ -141,6 +117,8 @@ class RunForm(ModelForm):
     duration_hours = IntegerField(min_value=0, required=False)
     duration_minutes = IntegerField(min_value=0, required=False)
     duration_seconds = IntegerField(min_value=0, required=False)
+    
+    seconds = IntegerField(required=False, widget=HiddenInput)
 
     def clean_distance(self): 
         distance = self.cleaned_data['distance']
@@ -197,13 +175,10 @@ class RunForm(ModelForm):
             else:
                 seconds = 0
 
-            try:
-                duration = hms_to_time(hours, minutes, seconds)
-            except: 
-                self._errors['duration'] = self.error_class(["Invalid duration: %s:%s:%s" % (hours,minutes,seconds)])
-
-            if duration > datetime.time(0,0,0,0): 
-                cleaned_data['duration'] = duration
+            total = (3600 * hours) + (60 * minutes) + seconds
+            if total > 0: 
+                cleaned_data['seconds'] = total
+                cleaned_data['duration'] = seconds_to_time(total)
             else: 
                 self._errors['duration'] = self.error_class(["Run must have non-zero duration."])
 
@@ -211,6 +186,8 @@ class RunForm(ModelForm):
 
     class Meta: 
         model = Run
+        exclude = ('calories_estimated', 'pace', 'speed', 'heartbeats', 
+            'efficiency', 'heart_rate_percent', 'fingerprint')
 
 class ShoeForm(ModelForm): 
 
@@ -236,15 +213,11 @@ class ImportForm(Form):
         def to_python(self, data_file):
 
             data_file.open()
-            line = ''.join(data_file.read())
-
-            try:
-                json_objs = json.loads(line)
-                return [obj_to_run(obj) for obj in json_objs]
-
-            except Exception as e:
-                log.info("ValidationError: %s", str(e))
-                raise ValidationError("Unable to parse JSON file. Error: %s." % str(e))
+            runs = ImportedRuns(data_file)
+            if runs.reader.next_char() != '[': 
+                log.info("ValidationError: not a JSON array")
+                raise ValidationError("Unable to parse JSON file. Error: expected a list of runs.")
+            return runs
 
     
     data_file = ImportableFileField(widget=FileInput(attrs={'tabindex': '1'}),
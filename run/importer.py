@@ -0,0 +1,260 @@
+"""
+Bulk import of a user's runs. Instead of saving each run (and so rebuilding
+its day's summaries through the signals), the derived fields are computed in
+memory with one profile lookup, the runs are inserted with bulk_create, and
+the summaries are rebuilt once from the earliest day touched.
+"""
+import decimal, logging
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import F, Min, Max, Sum
+
+from run.bulk import MAX_PARAMS, bulk_create, bulk_delete, bulk_update
+from run.models import Run, Shoe, DailySummary, Decimal
+from run.parallel import map_tasks
+from run.recalc import METRICS
+from run.sources import open_source
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+# the fields that importing a run again may change; the rest are in its
+# fingerprint. Whether the calories were estimated isn't compared, since a
+# file can't say so: it goes with the calories.
+UPSERT_FIELDS = ('average_heart_rate', 'calories', 'zone') + METRICS
+UPDATED_FIELDS = UPSERT_FIELDS + ('calories_estimated',)
+CALORIES = UPSERT_FIELDS.index('calories')
+
+def prepare(user, profile, run):
+    """
+    Sets everything that save() and its pre_save receivers would have.
+    """
+    run.user = user
+    # derive everything from the distance as it will be stored
+    places = Run._meta.get_field('distance').decimal_places
+    run.distance = Decimal(run.distance).quantize(decimal.Decimal(10) ** -places)
+    run.sync_seconds()
+    run.set_zone(profile)
+    if not run.calories:
+        run.set_calories(profile)
+    run.set_metrics(profile)
+    run.set_fingerprint()
+
+def erase_runs(user):
+    """
+    Deletes all of the user's runs without sending the delete signals, and
+    takes their distance off their shoes. Returns the (first, last) days
+    they covered, or None if there were none. The summaries must be rebuilt
+    afterwards.
+    """
+    existing = Run.objects.filter(user=user.id)
+    span = existing.aggregate(Min('date'), Max('date'))
+    if span['date__min'] is None:
+        return None
+
+    worn = (existing.filter(shoe__isnull=False).values('shoe')
+        .annotate(total=Sum('distance')))
+    for row in worn:
+        Shoe.objects.filter(id=row['shoe']).update(
+            miles=F('miles') - row['total'])
+    # deleting through the ORM would send the signals for every run
+    bulk_delete(existing)
+    return (span['date__min'], span['date__max'])
+
+def stored(values):
+    # compare as stored, as recalc does
+    return [Run._meta.get_field(field).get_db_prep_save(value,
+        connection=connection) for (field, value) in zip(UPSERT_FIELDS, values)]
+
+def existing_runs(user, fingerprints, last_id):
+    """
+    Maps each of the fingerprints to a list of (id, values of the
+    UPSERT_FIELDS, calories_estimated) for the user's runs with that
+    fingerprint, in id order. Only runs with ids up to last_id are included.
+    """
+    found = {}
+    fingerprints = list(fingerprints)
+    size = MAX_PARAMS - 2
+    for start in xrange(0, len(fingerprints), size):
+        rows = (Run.objects.filter(user=user.id, id__lte=last_id,
+            fingerprint__in=fingerprints[start:start + size]).order_by('id')
+            .values_list('fingerprint', 'id', 'calories_estimated',
+                *UPSERT_FIELDS))
+        for row in rows:
+            found.setdefault(row[0], []).append((row[1], row[3:], row[2]))
+    return found
+
+def import_runs(user, runs, erase=False, batch_size=BATCH_SIZE, progress=None, 
+        everyone=True):
+    """
+    Imports the (unsaved) runs for the user, first erasing the existing
+    ones if asked to. Otherwise runs that were imported before (that is,
+    with the same fingerprint) are matched up with the new ones: exact
+    duplicates are skipped, and those whose heart rate, calories or derived
+    fields differ are updated in place. A run given n times matches at most
+    n existing runs.
+
+    runs may be any iterable; it is consumed batch_size runs at a time, and
+    each batch is committed (and the numbers of runs read and added so far
+    are passed to progress, if given) so that a long import neither holds
+    a lock nor hides its progress. Check the input first if a partial
+    import would be a problem; if one batch fails, the summaries are still
+    rebuilt for those before it. The all-users summaries are rebuilt too
+    unless everyone is False.
+    Returns (added, changed, span), where span is the (first, last) range
+    of days whose aggregates are now stale, or None if nothing changed.
+    """
+    profile = user.get_profile()
+    first, last = None, None
+    if erase:
+        with transaction.commit_on_success():
+            erased = erase_runs(user)
+        if erased:
+            first, last = erased
+    # only match runs from before the import, not ones it added
+    last_id = Run.objects.aggregate(Max('id'))['id__max'] or 0
+    matched = {} # fingerprint: number of runs given with it so far
+
+    added, changed, count = 0, 0, 0
+    runs = iter(runs)
+    try:
+        while True:
+            batch = list(islice(runs, batch_size))
+            if not batch:
+                break
+            for run in batch:
+                prepare(user, profile, run)
+
+            new, updates = batch, []
+            if not erase:
+                found = existing_runs(user,
+                    set(run.fingerprint for run in batch), last_id)
+                new = []
+                for run in batch:
+                    n = matched.get(run.fingerprint, 0)
+                    matched[run.fingerprint] = n + 1
+                    candidates = found.get(run.fingerprint, ())
+                    if n >= len(candidates):
+                        new.append(run)
+                        continue
+                    (id, values, estimated) = candidates[n]
+                    mine = tuple(getattr(run, field) for field in UPSERT_FIELDS)
+                    (mine, values) = (stored(mine), stored(values))
+                    if mine != values:
+                        run.id = id
+                        if mine[CALORIES] == values[CALORIES]:
+                            run.calories_estimated = estimated
+                        updates.append(run)
+
+            for run in new + updates:
+                if first is None or run.date < first:
+                    first = run.date
+                if last is None or run.date > last:
+                    last = run.date
+            with transaction.commit_on_success():
+                bulk_create(Run, new)
+                bulk_update(Run, UPDATED_FIELDS, [(run.id, tuple(getattr(run,
+                    field) for field in UPDATED_FIELDS)) for run in updates])
+            added += len(new)
+            changed += len(updates)
+            count += len(batch)
+            if progress:
+                progress(count, added)
+    finally:
+        # the batches committed so far need their summaries even if a later
+        # one failed
+        if first is not None:
+            with transaction.commit_on_success():
+                DailySummary.rebuild_from(user.id, first)
+                if everyone:
+                    DailySummary.rebuild_from(None, first)
+
+    if first is None:
+        return (0, 0, None)
+
+    log.info("Imported %d new and %d changed runs for %s" % (added, changed,
+        user))
+    return (added, changed, (first, last))
+
+def import_file(user, path, format=None, erase=False, batch_size=BATCH_SIZE,
+        everyone=True):
+    """
+    Imports the runs in a file of the given format (or of the format that
+    it looks like) for the user. Returns a dict of counts: records read,
+    runs added, runs changed, runs already imported, records skipped as
+    errors and records ignored as other activities, along with the format
+    and the stale span of days.
+    """
+    with open(path, 'rb') as data_file:
+        source = open_source(data_file, format)
+        counter = []
+        (added, changed, span) = import_runs(user, source, erase=erase,
+            batch_size=batch_size, everyone=everyone,
+            progress=lambda count, added: counter.append(count))
+    count = counter[-1] if counter else 0
+    for (index, offset, message) in source.errors:
+        log.info("%s: skipped record %d (byte %d): %s" % (path, index, offset,
+            message))
+    return {'format': source.name,
+        'read': count + len(source.errors) + source.ignored,
+        'added': added,
+        'changed': changed,
+        'duplicates': count - added - changed,
+        'skipped': len(source.errors),
+        'ignored': source.ignored,
+        'span': span}
+
+def import_user_files(user_id, paths, format=None, erase=False,
+        batch_size=BATCH_SIZE):
+    """
+    Imports the files for one user in turn, leaving the all-users summaries
+    to the caller. Only the first file erases. Returns a list with the
+    counts of import_file for each file, or with the error for a file that
+    couldn't be imported.
+    """
+    user = User.objects.get(id=user_id)
+    results = []
+    for path in paths:
+        try:
+            results.append(import_file(user, path, format, erase, batch_size,
+                everyone=False))
+        except Exception as e:
+            log.exception("Unable to import %s" % path)
+            results.append({'error': str(e)})
+        erase = False
+    return results
+
+def import_files(pairs, format=None, erase=False, jobs=1,
+        batch_size=BATCH_SIZE):
+    """
+    Imports each of the (user, path) pairs, with up to `jobs` users at a
+    time in separate processes (each user's files are imported in order by
+    one process), then rebuilds the all-users summaries once. Returns a
+    list of (user, path, counts) in the order given.
+    """
+    paths = {}
+    for (user, path) in pairs:
+        paths.setdefault(user.id, []).append(path)
+    tasks = [(user_id, paths[user_id], format, erase, batch_size)
+        for user_id in sorted(paths)]
+
+    results = map_tasks(import_user_files, tasks, jobs)
+
+    counts = dict(zip(sorted(paths), results))
+    first = None
+    for user_results in results:
+        for result in user_results:
+            span = result.get('span')
+            if span and (first is None or span[0] < first):
+                first = span[0]
+    if first is not None:
+        with transaction.commit_on_success():
+            DailySummary.rebuild_from(None, first)
+
+    # each user's results are in the order of their files
+    order = dict((user_id, iter(user_counts))
+        for (user_id, user_counts) in counts.items())
+    return [(user, path, order[user.id].next()) for (user, path) in pairs]
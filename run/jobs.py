@@ -0,0 +1,157 @@
+"""
+A database-backed queue of import jobs. The web process saves the upload to
+disk and queues an ImportJob; the run_imports command claims queued jobs
+and imports them, recording its progress on the job as it goes. Profile
+changes queue a RecalcJob to recompute the user's runs the same way. A running
+job that hasn't recorded any progress for JOB_TIMEOUT is taken to have lost
+its worker and is claimed again; importing a file again only adds the runs
+that are missing.
+"""
+import datetime, logging, os, uuid
+
+from django.conf import settings
+from django.db.models import Min, Max, Q
+
+from run.importer import import_runs
+from run.jsonstream import JSONStreamError
+from run.models import ImportJob, RecalcJob, Run
+from run.sources import ImportedRuns
+
+log = logging.getLogger(__name__)
+
+# how often to record the count while checking a file
+PROGRESS_RECORDS = 1000
+
+# reported per job
+MAX_RECORD_ERRORS = 5
+
+# how long a running job can go without recording progress
+JOB_TIMEOUT = datetime.timedelta(minutes=30)
+
+def import_dir():
+    directory = settings.RUN_IMPORT_DIR
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+def enqueue_import(user, data_file, erase=False):
+    """
+    Saves the uploaded file and queues it to be imported for the user.
+    """
+    path = os.path.join(import_dir(), '%d-%s.json' % (user.id, uuid.uuid4().hex))
+    data_file.seek(0)
+    with open(path, 'wb') as f:
+        for chunk in data_file.chunks():
+            f.write(chunk)
+    job = ImportJob.objects.create(user=user, path=path, erase=erase)
+    log.info("Queued %s" % job)
+    return job
+
+def enqueue_recalc(user, changed):
+    """
+    Queues the user's runs to be recomputed after changes to the given
+    profile inputs.
+    """
+    return RecalcJob.objects.create(user=user,
+        changed=" ".join(sorted(changed)))
+
+def claim_next(model=ImportJob):
+    """
+    Marks the oldest queued (or timed out) job of the model as running and
+    returns it, or returns None if there are none. The update only succeeds
+    for one claimant, so any number of workers can share the queue.
+    """
+    now = datetime.datetime.now()
+    waiting = (model.objects.filter(Q(status=model.QUEUED) |
+        Q(status=model.RUNNING, updated__lt=now - JOB_TIMEOUT)))
+    for job in waiting.order_by('id')[:10]:
+        claimed = (model.objects.filter(id=job.id, status=job.status,
+            updated=job.updated).update(status=model.RUNNING, updated=now))
+        if claimed:
+            if job.status == model.RUNNING:
+                log.warning("Reclaimed %s, last updated %s" % (job, job.updated))
+            job.status = model.RUNNING
+            job.updated = now
+            return job
+    return None
+
+def record(job, **fields):
+    fields['updated'] = datetime.datetime.now()
+    for (field, value) in fields.items():
+        setattr(job, field, value)
+    type(job).objects.filter(id=job.id).update(**fields)
+
+def describe_errors(errors):
+    return "; ".join("record %d (byte %d): %s" % error
+        for error in errors[:MAX_RECORD_ERRORS])
+
+def run_job(job):
+    """
+    Imports a claimed job's file. The whole file is read once to check it
+    (and count its records) before anything is imported, so a malformed
+    file fails without changing any runs. Returns the (first, last) span of
+    days whose aggregates are stale, or None. If the import itself fails,
+    the runs it committed are kept, so the span returned then is every day
+    that it could have touched.
+    """
+    stale = None
+    try:
+        with open(job.path, 'rb') as f:
+            runs = ImportedRuns(f)
+            count = 0
+            (first, last) = (None, None)
+            for run in runs:
+                count += 1
+                if first is None or run.date < first:
+                    first = run.date
+                if last is None or run.date > last:
+                    last = run.date
+                if count % PROGRESS_RECORDS == 0:
+                    record(job, parsed=count + len(runs.errors))
+        record(job, parsed=count + len(runs.errors), failed=len(runs.errors),
+            message=describe_errors(runs.errors))
+
+        dates = [first, last]
+        if job.erase:
+            erased = Run.objects.filter(user=job.user)
+            dates.extend(erased.aggregate(Min('date'), Max('date')).values())
+        dates = filter(None, dates)
+        if dates:
+            stale = (min(dates), max(dates))
+        with open(job.path, 'rb') as f:
+            (added, changed, span) = import_runs(job.user, ImportedRuns(f),
+                erase=job.erase,
+                progress=lambda count, added: record(job, inserted=added))
+        summary = ("%d new runs, %d changed, %d already imported." % (added,
+            changed, count - added - changed))
+        record(job, status=ImportJob.DONE, inserted=added,
+            finished=datetime.datetime.now(),
+            message=" ".join(filter(None, (summary, job.message))))
+        log.info("Finished %s: %s" % (job, summary))
+        return span
+    except JSONStreamError as e:
+        record(job, status=ImportJob.FAILED, finished=datetime.datetime.now(),
+            message="Unable to parse JSON file. Error: %s." % e)
+    except Exception:
+        log.exception("Import failed: %s" % job)
+        record(job, status=ImportJob.FAILED, finished=datetime.datetime.now(),
+            message="Import failed.")
+        return stale
+    finally:
+        if os.path.exists(job.path):
+            os.remove(job.path)
+    return None
+
+def run_recalc_job(job):
+    """
+    Recomputes the runs of a claimed recalculation job, and invalidates the
+    aggregates that they change.
+    """
+    from run.views import recompute_for_profile # views imports this module
+    try:
+        recompute_for_profile(job.user, set(job.changed.split()))
+        record(job, status=RecalcJob.DONE, finished=datetime.datetime.now())
+    except Exception:
+        log.exception("Recalculation failed: %s" % job)
+        record(job, status=RecalcJob.FAILED, finished=datetime.datetime.now(),
+            message="Recalculation failed.")
@@ -0,0 +1,103 @@
+"""
+Incremental parsing of a JSON array from a file, one element at a time, so
+that memory use depends on the size of the largest element rather than the
+size of the file.
+"""
+import json
+
+CHUNK_SIZE = 64 * 1024
+MAX_ELEMENT_SIZE = 1024 * 1024
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = tuple(WHITESPACE + ',]')
+
+class JSONStreamError(ValueError):
+    def __init__(self, message, offset):
+        ValueError.__init__(self, "%s at byte %d" % (message, offset))
+        self.offset = offset
+
+class ArrayReader(object):
+    """
+    Reads the elements of a JSON array from a file-like object. Only the
+    unparsed part of the current chunk is kept in memory.
+    """
+    def __init__(self, data_file, chunk_size=CHUNK_SIZE):
+        self.data_file = data_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0 # in buf
+        self.dropped = 0 # bytes of the file before buf
+        self.eof = False
+
+    def offset(self):
+        return self.dropped + self.pos
+
+    def read_more(self):
+        chunk = self.data_file.read(self.chunk_size)
+        if chunk:
+            # drop what has already been parsed
+            self.buf = self.buf[self.pos:] + chunk
+            self.dropped += self.pos
+            self.pos = 0
+        else:
+            self.eof = True
+
+    def next_char(self):
+        """
+        Skips whitespace and returns the next character, or '' at the end.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.read_more()
+
+    def next_element(self):
+        start = self.offset()
+        while True:
+            try:
+                element, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number may go on past what has been read so far
+                if self.eof or self.buf[end:end + 1] in DELIMITERS:
+                    self.pos = end
+                    return element
+            except ValueError as e:
+                if self.eof:
+                    raise JSONStreamError(str(e), start)
+            if len(self.buf) - self.pos > MAX_ELEMENT_SIZE:
+                raise JSONStreamError("Record too large or malformed", start)
+            self.read_more()
+
+    def __iter__(self):
+        """
+        Yields (index, offset, element) for each element of the array, where
+        offset is the element's position in the file in bytes.
+        """
+        if self.next_char() != '[':
+            raise JSONStreamError("Expected a JSON array", self.offset())
+        self.pos += 1
+        if self.next_char() == ']':
+            return
+
+        index = 0
+        while True:
+            if self.next_char() == '':
+                raise JSONStreamError("Unexpected end of file", self.offset())
+            offset = self.offset()
+            yield (index, offset, self.next_element())
+            index += 1
+
+            c = self.next_char()
+            if c == ']':
+                return
+            elif c == ',':
+                self.pos += 1
+            elif c == '':
+                raise JSONStreamError("Unexpected end of file", self.offset())
+            else:
+                raise JSONStreamError("Expected ',' or ']'", self.offset())
+
+def iter_array(data_file, chunk_size=CHUNK_SIZE):
+    return iter(ArrayReader(data_file, chunk_size))
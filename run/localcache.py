@@ -0,0 +1,203 @@
+import logging, time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache as backend_cache
+
+from run import perf
+
+log = logging.getLogger(__name__)
+
+VERSION_KEY = 'LOCAL_CACHE_VERSION'
+
+class CountedCache(object):
+    """
+    The shared cache, with its gets (and their hits and misses) and sets 
+    counted for run.perf. Everything else is passed straight through. 
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _gets(self, gets, hits):
+        perf.count('cache_gets', gets)
+        perf.count('cache_hits', hits)
+        perf.count('cache_misses', gets - hits)
+
+    def get(self, key, default=None, **kwargs):
+        value = self.backend.get(key, **kwargs)
+        self._gets(1, int(value is not None))
+        if value is None:
+            return default
+        return value
+
+    def get_many(self, keys, **kwargs):
+        keys = list(keys)
+        values = self.backend.get_many(keys, **kwargs)
+        self._gets(len(keys), len(values))
+        return values
+
+    def add(self, key, value, *args, **kwargs):
+        perf.count('cache_sets')
+        return self.backend.add(key, value, *args, **kwargs)
+
+    def set(self, key, value, *args, **kwargs):
+        perf.count('cache_sets')
+        return self.backend.set(key, value, *args, **kwargs)
+
+    def set_many(self, data, *args, **kwargs):
+        perf.count('cache_sets', len(data))
+        return self.backend.set_many(data, *args, **kwargs)
+
+shared_cache = CountedCache(backend_cache)
+
+class LocalCache(object):
+    """
+    A small per-process LRU cache in front of the shared (memcached) cache.
+
+    Values are kept locally for at most `timeout` seconds. Every write that
+    can make another process's copy stale (set, delete, incr) also bumps a
+    shared version number; each process compares it against its own at most
+    once every `check_interval` seconds and drops its local entries when it
+    has changed. Fill-ins after a miss should use add or set_many, which
+    don't bump the version.
+    """
+    def __init__(self, backend, max_entries=500, timeout=5, check_interval=1):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.version = None
+        self.checked = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+            'entries': len(self.entries)}
+
+    def _check_version(self):
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        version = self.backend.get(VERSION_KEY)
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def _bump_version(self):
+        try:
+            version = self.backend.incr(VERSION_KEY)
+        except ValueError:
+            self.backend.add(VERSION_KEY, 1)
+            version = self.backend.get(VERSION_KEY)
+        if self.version is None or version != self.version + 1:
+            # someone else wrote in the meantime
+            self.entries.clear()
+        self.version = version
+
+    def _get_local(self, key):
+        entry = self.entries.pop(key, None)
+        if entry and entry[1] > time.time():
+            self.entries[key] = entry # most recently used goes last
+            self.hits += 1
+            perf.count('local_hits')
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def _put_local(self, key, value):
+        if value is None:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (value, time.time() + self.timeout)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        self._check_version()
+        value = self._get_local(key)
+        if value is None:
+            value = self.backend.get(key)
+            self._put_local(key, value)
+        if value is None:
+            return default
+        return value
+
+    def get_many(self, keys):
+        self._check_version()
+        values = {}
+        misses = []
+        for key in keys:
+            value = self._get_local(key)
+            if value is None:
+                misses.append(key)
+            else:
+                values[key] = value
+        if misses:
+            fetched = self.backend.get_many(misses)
+            for (key, value) in fetched.items():
+                self._put_local(key, value)
+            values.update(fetched)
+        return values
+
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            added = self.backend.add(key, value)
+        else:
+            added = self.backend.add(key, value, timeout)
+        if added:
+            self._put_local(key, value)
+        return added
+
+    def set_many(self, data, timeout=None):
+        if timeout is None:
+            self.backend.set_many(data)
+        else:
+            self.backend.set_many(data, timeout)
+        for (key, value) in data.items():
+            self._put_local(key, value)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            self.backend.set(key, value)
+        else:
+            self.backend.set(key, value, timeout)
+        self._bump_version()
+        self._put_local(key, value)
+
+    def delete(self, key):
+        self.backend.delete(key)
+        self.entries.pop(key, None)
+        self._bump_version()
+
+    def delete_many(self, keys):
+        self.backend.delete_many(keys)
+        for key in keys:
+            self.entries.pop(key, None)
+        self._bump_version()
+
+    def incr(self, key, delta=1):
+        self.entries.pop(key, None)
+        value = self.backend.incr(key, delta)
+        self._bump_version()
+        return value
+
+def get_cache():
+    """
+    Returns the shared cache, fronted by a LocalCache if RUN_LOCAL_CACHE is
+    configured in the settings.
+    """
+    options = getattr(settings, 'RUN_LOCAL_CACHE', None)
+    if options is None:
+        return shared_cache
+    return LocalCache(shared_cache,
+        max_entries=options.get('MAX_ENTRIES', 500),
+        timeout=options.get('TIMEOUT', 5),
+        check_interval=options.get('CHECK_INTERVAL', 1))
+
+cache = get_cache()
@@ -0,0 +1,112 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from run import importer, recalc, sources
+from run.views import invalidate_cache, invalidate_days, reset_last_modified
+
+class RecalculateCommand(BaseCommand):
+    """
+    Recomputes some of the derived run fields for the given users (or for 
+    everyone) with the batch engine in run.recalc. 
+    """
+    args = '[username ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', type='int', default=1, 
+            help='Number of users to recalculate in parallel processes'),
+        make_option('--chunk-size', type='int', default=recalc.CHUNK_SIZE, 
+            help='Number of runs to load and update at a time'),
+    )
+    fields = recalc.FIELDS
+
+    def handle(self, *args, **options):
+
+        users = User.objects.all()
+        if args: 
+            users = users.filter(username__in=args)
+        users = dict((user.id, user) for user in users)
+        if options['jobs'] < 1: 
+            raise CommandError("--jobs must be at least 1")
+
+        results = recalc.recalculate(sorted(users), self.fields, 
+            jobs=options['jobs'], chunk_size=options['chunk_size'])
+
+        total = 0
+        for (user_id, (changed, deltas)) in sorted(results.items()): 
+            user = users[user_id]
+            invalidate_days(user, deltas.keys())
+            if changed: 
+                reset_last_modified(user)
+            total += changed
+        self.stdout.write("Runs updated: %d\n" % total)
+
+class ImportCommand(BaseCommand):
+    """
+    Imports files of runs for users with run.importer, up to --jobs users at
+    a time, and reports the counts for each file. The format of each file is
+    detected unless --format is given, and must be one of formats. 
+    """
+    args = '<username file> [<username file> ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', type='int', default=1, 
+            help='Number of users to import in parallel processes'),
+        make_option('--batch-size', type='int', default=importer.BATCH_SIZE, 
+            help='Number of runs to insert at a time'),
+        make_option('--format', choices=sorted(sources.SOURCES), default=None, 
+            help='Format of the files, if not detected'),
+        make_option('--erase', action='store_true', default=False, 
+            help="Erase each user's existing runs first"),
+    )
+    formats = tuple(sorted(sources.SOURCES))
+
+    def handle(self, *args, **options):
+
+        if not args or len(args) % 2: 
+            raise CommandError("Expected pairs of username and file")
+        if options['jobs'] < 1: 
+            raise CommandError("--jobs must be at least 1")
+
+        pairs = []
+        users = {}
+        for (username, path) in zip(args[::2], args[1::2]): 
+            if username not in users: 
+                try: 
+                    users[username] = User.objects.get(username__exact=username)
+                except User.DoesNotExist: 
+                    raise CommandError("No such user: %s" % username)
+            format = options['format']
+            try: 
+                with open(path, 'rb') as data_file: 
+                    format = format or sources.detect(data_file)
+            except (IOError, sources.UnknownFormat) as e: 
+                raise CommandError("%s: %s" % (path, e))
+            if format not in self.formats: 
+                raise CommandError("%s: not a %s file" % (path, 
+                    ' or '.join(self.formats)))
+            pairs.append((users[username], path))
+
+        results = importer.import_files(pairs, format=options['format'], 
+            erase=options['erase'], jobs=options['jobs'], 
+            batch_size=options['batch_size'])
+
+        fields = ('read', 'added', 'changed', 'duplicates', 'skipped', 'ignored')
+        totals = dict.fromkeys(fields + ('failed',), 0)
+        for (user, path, counts) in results: 
+            if 'error' in counts: 
+                totals['failed'] += 1
+                self.stdout.write("%s %s: failed: %s\n" % (user, path, counts['error']))
+                continue
+            if counts['span']: 
+                invalidate_cache(user, *counts['span'])
+            for field in fields: 
+                totals[field] += counts[field]
+            self.stdout.write("%s %s (%s): " % (user, path, counts['format']) + 
+                self.describe(counts) + "\n")
+        self.stdout.write("Total: %s, %d files failed\n" % 
+            (self.describe(totals), totals['failed']))
+
+    def describe(self, counts): 
+        return ("%(read)d read, %(added)d added, %(changed)d changed, "
+            "%(duplicates)d already imported, %(skipped)d skipped, "
+            "%(ignored)d ignored" % counts)
@@ -0,0 +1,96 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection
+
+from run.models import Run, Aggregate, DailySummary
+from run.views import summaries_in_range, surrounding_month, surrounding_week
+
+def hot_queries(user_id, today):
+    """
+    The queries behind the pages and imports, as (name, queryset) pairs.
+    """
+    week = surrounding_week(today)
+    month = surrounding_month(today)
+    year_ago = today - datetime.timedelta(days=365)
+    summaries = DailySummary.objects.for_user(user_id)
+    return [
+        ('recent runs', Run.objects.filter(user=user_id).order_by('-date')[:5]),
+        ('runs in range', Run.objects.filter(user=user_id, date__gte=year_ago,
+            date__lte=today)),
+        ('yield runs', Run.objects.filter(user=user_id, average_heart_rate__gt=0)
+            .order_by('date').values_list('date', 'speed', 'efficiency',
+                'average_heart_rate', 'pace')),
+        ('runs by fingerprint', Run.objects.filter(user=user_id,
+            fingerprint__in=['0' * 40, 'f' * 40])),
+        ('summaries in range', summaries_in_range(User(id=user_id), year_ago,
+            today)),
+        ('everyone summaries in range', summaries_in_range(None, year_ago, today)),
+        ('range totals', summaries.filter(date__lte=today).order_by('-date')[:1]),
+        ('everyone range totals', DailySummary.objects.for_user(None).filter(
+            date__lte=today).order_by('-date')[:1]),
+        ('aggregates by period', Aggregate.objects.for_user(user_id).filter(
+            first_date__in=[week[0], month[0]])),
+        ('aggregates covering day', Aggregate.objects.for_user(user_id).filter(
+            first_date__lte=today, last_date__gte=today)),
+        ('everyone aggregates covering day', Aggregate.objects.for_user(None).filter(
+            first_date__lte=today, last_date__gte=today)),
+    ]
+
+def explain(queryset):
+    (sql, params) = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return (sql, [' '.join(str(column) for column in row)
+        for row in cursor.fetchall()])
+
+def scans(plan):
+    """
+    The lines of a plan that read a whole table.
+    """
+    return [line for line in plan if ('SCAN' in line and 'INDEX' not in line)
+        or 'Seq Scan' in line]
+
+class Command(BaseCommand):
+    args = '[username]'
+    help = 'Prints the query plans of the most frequent queries, marking full table scans'
+    option_list = BaseCommand.option_list + (
+        make_option('--strict', action='store_true', default=False,
+            help='Fail if any plan scans a whole table'),
+        make_option('--sql', action='store_true', default=False,
+            help='Print the SQL of each query too'),
+    )
+
+    def handle(self, *args, **options):
+
+        if args:
+            try:
+                user_id = User.objects.get(username__exact=args[0]).id
+            except User.DoesNotExist:
+                raise CommandError("No such user: %s" % args[0])
+        else:
+            user_id = 1 # the plans don't depend on who it is
+
+        full = []
+        for (name, queryset) in hot_queries(user_id, datetime.date.today()):
+            (sql, plan) = explain(queryset)
+            self.stdout.write("%s:\n" % name)
+            if options['sql']:
+                self.stdout.write("    %s\n" % sql)
+            for line in plan:
+                marker = '  <-- full scan' if line in scans(plan) else ''
+                self.stdout.write("    %s%s\n" % (line, marker))
+            if scans(plan):
+                full.append(name)
+
+        if full:
+            message = "Full table scans: %s" % ", ".join(full)
+            if options['strict']:
+                raise CommandError(message)
+            self.stdout.write(message + "\n")
@@ -0,0 +1,4 @@
+from run.management.base import ImportCommand
+
+class Command(ImportCommand):
+    help = 'Imports files of runs (JSON, DailyMile or Flotrack) for users'
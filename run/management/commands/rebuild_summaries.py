@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from run.models import Run, DailySummary, Aggregate
+
+class Command(BaseCommand):
+    args = '[username ...]'
+    help = 'Rebuilds the daily run summaries (and clears derived aggregates)'
+
+    def handle(self, *args, **options):
+
+        if args: 
+            users = User.objects.filter(username__in=args)
+        else: 
+            users = User.objects.all()
+
+        for user in users: 
+            DailySummary.objects.filter(user=user.id).delete()
+            days = (Run.objects.filter(user=user.id)
+                .order_by('date').values_list('date', flat=True).distinct())
+            for day in days: 
+                DailySummary.rebuild(user.id, day)
+            Aggregate.objects.filter(user=user.id).delete()
+            self.stdout.write("%s: %d days\n" % (user.username, len(days)))
+
+        # the all-users totals are summed from the per-user days
+        DailySummary.objects.for_user(None).delete()
+        days = (DailySummary.objects.filter(user__isnull=False)
+            .order_by('date').values_list('date', flat=True).distinct())
+        for day in days: 
+            DailySummary.rebuild(None, day)
+        Aggregate.objects.for_user(None).delete()
+        self.stdout.write("everyone: %d days\n" % len(days))
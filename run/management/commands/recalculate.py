@@ -0,0 +1,4 @@
+from run.management.base import RecalculateCommand
+
+class Command(RecalculateCommand):
+    help = 'Recomputes the calories, zone and derived metrics of runs '
@@ -0,0 +1,39 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from run import jobs
+from run.models import RecalcJob
+from run.views import invalidate_cache
+
+class Command(BaseCommand):
+    help = ('Imports the queued run uploads and recomputes runs after profile '
+        'changes, waiting for more unless --once is given')
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', default=False, 
+            help='Exit when the queue is empty'),
+        make_option('--poll', type='float', default=2.0, 
+            help='Seconds to wait between checks of an empty queue'),
+    )
+
+    def handle(self, *args, **options):
+
+        while True: 
+            job = jobs.claim_next(RecalcJob)
+            if job is not None: 
+                jobs.run_recalc_job(job)
+                self.stdout.write("%s\n" % job)
+                continue
+
+            job = jobs.claim_next()
+            if job is None: 
+                if options['once']: 
+                    break
+                time.sleep(options['poll'])
+                continue
+
+            span = jobs.run_job(job)
+            if span: 
+                invalidate_cache(job.user, *span)
+            self.stdout.write("%s: %d runs added from %d records\n" % 
+                (job, job.inserted, job.parsed))
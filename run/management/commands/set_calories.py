@@ -1,15 +1,5 @@
-from django.core.management.base import BaseCommand, CommandError
-from run.models import Run
+from run.management.base import RecalculateCommand
 
-class Command(BaseCommand):
-    # args = '<username file.csv>'
+class Command(RecalculateCommand):
     help = 'Computes and sets the the \'calories\' field for runs '
-
-    def handle(self, *args, **options):
-
-        for run in Run.objects.all(): 
-            if not run.calories: 
-                run.set_calories()
-                run.save()
-                print "Run: %s" % str(run)
-                print "Calories: %d" % run.calories
\ No newline at end of file
+    fields = ('calories',)
@@ -0,0 +1,5 @@
+from run.management.base import RecalculateCommand
+
+class Command(RecalculateCommand):
+    help = 'Computes and stores the fingerprints that imports use to find runs already imported'
+    fields = ('fingerprint',)
@@ -0,0 +1,6 @@
+from run import recalc
+from run.management.base import RecalculateCommand
+
+class Command(RecalculateCommand):
+    help = 'Computes and stores the derived per-run metrics (pace, speed, etc.) '
+    fields = recalc.METRICS
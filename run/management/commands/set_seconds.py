@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from run.models import Run
+
+class Command(BaseCommand):
+    help = 'Fills in the \'seconds\' field from the \'duration\' field for runs '
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+
+        count = 0
+        runs = Run.objects.filter(seconds=0).values_list('id', 'duration')
+        for (id, t) in runs.iterator(): 
+            if t: 
+                seconds = (3600 * t.hour) + (60 * t.minute) + t.second
+                # update() skips the save signals; nothing derived changes
+                Run.objects.filter(id=id).update(seconds=seconds)
+                count += 1
+        self.stdout.write("Runs updated: %d\n" % count)
@@ -0,0 +1,124 @@
+import re
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection, transaction
+from run.models import Run, Aggregate, DailySummary
+
+def table_columns(cursor, table):
+    """
+    Maps each column of the (SQLite) table to whether it is NOT NULL.
+    """
+    cursor.execute("PRAGMA table_info(%s)" % connection.ops.quote_name(table))
+    return dict((row[1], bool(row[3])) for row in cursor.fetchall())
+
+def unique_columns(cursor, table):
+    """
+    The sets of columns that the (SQLite) table's unique indexes are on.
+    """
+    qn = connection.ops.quote_name
+    cursor.execute("PRAGMA index_list(%s)" % qn(table))
+    indexes = [row[1] for row in cursor.fetchall() if row[2]]
+    unique = []
+    for index in indexes:
+        cursor.execute("PRAGMA index_info(%s)" % qn(index))
+        unique.append(frozenset(row[2] for row in cursor.fetchall()))
+    return unique
+
+def outdated(cursor, model):
+    """
+    Whether the model's table lacks any of its columns or unique
+    constraints, or makes NOT NULL a column that may now be null.
+    """
+    table = model._meta.db_table
+    columns = table_columns(cursor, table)
+    for field in model._meta.local_fields:
+        if field.column not in columns:
+            return True
+        if field.null and columns[field.column]:
+            return True
+    unique = unique_columns(cursor, table)
+    for names in model._meta.unique_together:
+        together = frozenset(model._meta.get_field(name).column
+            for name in names)
+        if together not in unique:
+            return True
+    return False
+
+def index_names(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    return set(row[0] for row in cursor.fetchall())
+
+class Command(BaseCommand):
+    help = ('Upgrades the run tables of an existing SQLite database to the '
+        'current models (back it up first). Then run set_seconds, set_metrics, '
+        'set_fingerprints and rebuild_summaries, in that order.')
+
+    def handle(self, *args, **options):
+
+        if connection.vendor != 'sqlite':
+            raise CommandError("Only SQLite databases can be upgraded this way")
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        tables = connection.introspection.table_names()
+
+        # SQLite can't drop a NOT NULL (from duration), so the runs are
+        # moved aside, and copied into the table that syncdb creates
+        old = None
+        if Run._meta.db_table in tables and outdated(cursor, Run):
+            old = Run._meta.db_table + '_old'
+            cursor.execute("ALTER TABLE %s RENAME TO %s" % (
+                qn(Run._meta.db_table), qn(old)))
+            # the indexes moved with it, but their names must be free
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = %s AND sql IS NOT NULL", [old])
+            for (index,) in cursor.fetchall():
+                cursor.execute("DROP INDEX %s" % qn(index))
+            self.stdout.write("Moved the runs to %s\n" % old)
+
+        # the aggregates and summaries are only sums of the runs, recomputed
+        # when missing (by rebuild_summaries, for the summaries)
+        for model in (Aggregate, DailySummary):
+            table = model._meta.db_table
+            if table in tables and outdated(cursor, model):
+                cursor.execute("DROP TABLE %s" % qn(table))
+                self.stdout.write("Dropped the old %s\n" % table)
+        transaction.commit_unless_managed()
+
+        # creates the missing tables, with their indexes and run/sql/*.sql
+        call_command('syncdb', interactive=False,
+            verbosity=options.get('verbosity', 1))
+
+        if old:
+            cursor = connection.cursor() # syncdb closes the connection
+            old_columns = table_columns(cursor, old)
+            columns, values, params = [], [], []
+            for field in Run._meta.local_fields:
+                columns.append(qn(field.column))
+                if field.column in old_columns:
+                    values.append(qn(field.column))
+                else: # filled in by the set_ commands
+                    values.append("%s")
+                    params.append(field.get_db_prep_save(field.get_default(),
+                        connection=connection))
+            cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+                qn(Run._meta.db_table), ", ".join(columns), ", ".join(values),
+                qn(old)), params)
+            count = cursor.rowcount
+            cursor.execute("DROP TABLE %s" % qn(old))
+            transaction.commit_unless_managed()
+            self.stdout.write("Copied %d runs\n" % count)
+
+        # syncdb only runs run/sql/*.sql for the tables it creates
+        cursor = connection.cursor()
+        existing = index_names(cursor)
+        for model in (Run, Aggregate, DailySummary):
+            statements = custom_sql_for_model(model, no_style(), connection)
+            for statement in statements:
+                match = re.match(r"\s*CREATE (UNIQUE )?INDEX (\w+)", statement)
+                if match and match.group(2) not in existing:
+                    cursor.execute(statement)
+                    self.stdout.write("Created index %s\n" % match.group(2))
+        transaction.commit_unless_managed()
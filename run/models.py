@@ -1,11 +1,16 @@
-from django.db import models
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F, Min, Max
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-import decimal
+import decimal, hashlib
 from decimal import getcontext
 from datetime import date, datetime, time
 
+from run.bulk import bulk_create, bulk_update
+from run.localcache import shared_cache as cache # counted for run.perf
+from run.ranges import DateRangeExtrema
+
 def Decimal(f): 
     return decimal.Decimal(str(f))
 
@@ -13,6 +18,23 @@ meters_per_mile = Decimal(1609.344)
 kg_per_pound = Decimal(0.45359237)
 cal_per_joule = Decimal(0.239005736)
 
+class UserRowsManager(models.Manager): 
+    """
+    For models with a row per user and period, plus all-users rows whose 
+    user is NULL. 
+    """
+    def for_user(self, user_id): 
+        """
+        The user's rows, or the all-users rows if user_id is None. 
+        """
+        if user_id is None: 
+            # filter(user=None) joins the users table (as of Django 1.4), 
+            # which keeps the (user, ...) indexes from being used
+            qn = connection.ops.quote_name
+            return self.extra(where=["%s.%s IS NULL" % 
+                (qn(self.model._meta.db_table), qn('user_id'))])
+        return self.filter(user=user_id)
+
 class Shoe(models.Model):
     user = models.ForeignKey(User)
     make = models.CharField(max_length=100)
@@ -37,14 +59,19 @@ class UserProfile(models.Model):
             ", birthday: " + str(self.birthday) + ", HR: " + str(self.resting_heart_rate) + 
             ", last_shoe: " + str(self.last_shoe) + ")")
         
-    def maximum_heart_rate(self):
+    def maximum_heart_rate(self, on=None):
         if self.gender == True or self.gender == None: # men
-            return 205.8 - (0.685 * float(self.age_in_years()))
+            return 205.8 - (0.685 * float(self.age_in_years(on)))
         else: # women
-            return 206.0 - (0.88 * float(self.age_in_years()))
+            return 206.0 - (0.88 * float(self.age_in_years(on)))
 
-    def age_in_years(self): 
-        td = date.today() - self.birthday
+    def age_in_years(self, on=None): 
+        """
+        Age as of the given date, or today. 
+        """
+        if on is None: 
+            on = date.today()
+        td = on - self.birthday
         total_seconds = td.seconds + (3600 * 24 * td.days)
         seconds_in_year = 3600 * 24 * 365
         return int(total_seconds // seconds_in_year)
@@ -61,36 +88,108 @@ class Run(models.Model):
     shoe = models.ForeignKey(Shoe, blank=True, null=True, 
         on_delete=models.SET_NULL)
     date = models.DateField()
-    duration = models.TimeField()
+    # total duration; the time-of-day form is only kept for runs under a day
+    seconds = models.PositiveIntegerField(default=0)
+    duration = models.TimeField(blank=True, null=True)
     distance = models.DecimalField(max_digits=5, decimal_places=2)
     average_heart_rate = models.IntegerField(blank=True, null=True) 
     calories = models.IntegerField(blank=True, null=True)
+    # set by set_calories; calories that came with the run (from a device or 
+    # an import) are never recomputed
+    calories_estimated = models.BooleanField(default=False)
     zone = models.SmallIntegerField(blank=True, null=True)
+    # derived from the fields above by set_metrics() whenever the run is saved
+    pace = models.CharField(max_length=10, blank=True, null=True)
+    speed = models.DecimalField(max_digits=12, decimal_places=8, blank=True, null=True)
+    heartbeats = models.DecimalField(max_digits=9, decimal_places=3, blank=True, null=True)
+    efficiency = models.DecimalField(max_digits=12, decimal_places=8, default=0)
+    heart_rate_percent = models.DecimalField(max_digits=9, decimal_places=6, blank=True, null=True)
+    # identifies the run by user, date, distance and duration, so that 
+    # importing the same runs again doesn't duplicate them (indexed in sql/run.sql)
+    fingerprint = models.CharField(max_length=40, blank=True)
 
     def __unicode__(self):
         return str(self.distance) + " miles on " + str(self.date)
 
-    def heart_rate_percent(self):
-        maxhr = self.user.get_profile().maximum_heart_rate()
-        if maxhr and self.average_heart_rate:
-            return 100.0 * (self.average_heart_rate / maxhr)
-        else:
-            None
+    @staticmethod
+    def make_fingerprint(user_id, day, distance, seconds): 
+        # as stored, whatever form they were given in
+        day = Run._meta.get_field('date').to_python(day)
+        places = Run._meta.get_field('distance').decimal_places
+        distance = Decimal(distance).quantize(decimal.Decimal(10) ** -places)
+        key = "%d:%s:%s:%d" % (user_id, day.isoformat(), distance, seconds)
+        return hashlib.sha1(key).hexdigest()
+
+    def set_fingerprint(self): 
+        self.fingerprint = Run.make_fingerprint(self.user_id, self.date, 
+            self.distance, self.duration_in_seconds())
+
+    def set_metrics(self, profile=None):
+        """
+        Computes the pace, speed, heartbeats, efficiency and percentage of 
+        maximum heart rate. The percentage is of the maximum for the user's 
+        age on the day of the run, so it only goes stale when the profile 
+        changes (see run.recalc). 
+        """
+        seconds = self.duration_in_seconds()
+        hr = self.average_heart_rate
+        meters = Decimal(self.distance) * meters_per_mile
+        self.pace = Run.compute_pace(seconds, Decimal(self.distance))
+        if seconds > 0: 
+            self.speed = meters / seconds
+        else: 
+            self.speed = None
+        if hr: 
+            self.heartbeats = Decimal(hr) * (Decimal(seconds) / 60)
+            self.efficiency = Run.compute_efficiency(meters, self.heartbeats)
+        else: 
+            self.heartbeats = None
+            self.efficiency = 0
+        
+        if profile is None: 
+            profile = self.user.get_profile()
+        if hr and profile.birthday: 
+            maxhr = profile.maximum_heart_rate(self.date)
+            self.heart_rate_percent = Decimal(100.0 * (hr / maxhr))
+        else: 
+            self.heart_rate_percent = None
+        self._metrics_inputs = self.metrics_inputs()
+
+    def metrics_inputs(self): 
+        return (self.user_id, self.date, self.duration_in_seconds(), 
+            Decimal(self.distance), self.average_heart_rate)
 
     def duration_as_datetime(self):
         return datetime.combine(datetime.today(), self.duration)
         
     def duration_as_string(self):
-        return formatted_time(self.duration)
+        return formatted_seconds(self.duration_in_seconds())
 
     def duration_in_seconds(self):
-        t = self.duration
-        return (3600 * t.hour) + (60 * t.minute) + t.second
+        if self.seconds: 
+            return self.seconds
+        elif self.duration: 
+            return time_to_seconds(self.duration)
+        else: 
+            return 0
         
+    def sync_seconds(self): 
+        """
+        Brings seconds and duration into agreement; seconds wins. 
+        """
+        if self.seconds: 
+            self.duration = seconds_to_time(self.seconds)
+        elif self.duration: 
+            self.seconds = time_to_seconds(self.duration)
+
     def set_duration(self, hours, minutes, seconds):
-        d = hms_to_time(hours, minutes, seconds)
-        self.duration = d
-        return d
+        """
+        Sets the duration, which may exceed one day. Returns it as a time 
+        object, or None if it does. 
+        """
+        self.seconds = (3600 * hours) + (60 * minutes) + seconds
+        self.duration = seconds_to_time(self.seconds)
+        return self.duration
     
     @staticmethod    
     def compute_pace(duration_in_seconds, distance):
@@ -100,35 +199,21 @@ class Run(models.Model):
         else:
             return None
             
-    def pace(self):
-        return Run.compute_pace(self.duration_in_seconds(), self.distance)
-        
-    def heartbeats(self):
-        return (Decimal(self.average_heart_rate) * 
-            (Decimal(self.duration_in_seconds()) / 60))
+    def beat_seconds(self):
+        """
+        Heartbeats times 60, which is always a whole number. 
+        """
+        return self.average_heart_rate * self.duration_in_seconds()
         
     def distance_in_meters(self):
         return self.distance * meters_per_mile
 
-    def speed(self):
-        return self.distance_in_meters() / self.duration_in_seconds()
-        
     @staticmethod
     def compute_efficiency(distance_in_meters, heartbeats):
         if heartbeats > 0:
             return distance_in_meters / heartbeats
         else: 
             return 0
-                    
-    def efficiency(self):
-        """
-        Distance per effort (times a constant for readability)
-        """
-        if self.average_heart_rate:
-            return Run.compute_efficiency(self.distance_in_meters(), 
-                self.heartbeats())
-        else: 
-            return 0
     
     @staticmethod
     def compute_calories_per_sec(hr, is_male, weight, age, vO2max=None):
@@ -166,8 +251,9 @@ class Run(models.Model):
         
         return EE 
     
-    def set_calories(self):
-        profile = self.user.get_profile()
+    def set_calories(self, profile=None):
+        if profile is None: 
+            profile = self.user.get_profile()
         
         hr = self.average_heart_rate
         gender = profile.gender
@@ -186,9 +272,11 @@ class Run(models.Model):
             self.calories = int(float(weight_in_lbs) * 0.75 * float(self.distance))
         else: 
             self.calories = 0
+        self.calories_estimated = True
             
-    def set_zone(self):
-        profile = self.user.get_profile()
+    def set_zone(self, profile=None):
+        if profile is None: 
+            profile = self.user.get_profile()
 
         if self.average_heart_rate and profile.birthday and profile.resting_heart_rate: 
             
@@ -211,6 +299,8 @@ class Run(models.Model):
                 zone = 5
 
             self.zone = zone
+        else: 
+            self.zone = None
             
     def zone_description(self):
         zone = self.zone
@@ -234,6 +324,28 @@ def formatted_time(t):
     
     return output + t.strftime("%M:%S")
     
+def formatted_seconds(seconds): 
+    """
+    Like formatted_time, but for durations of any length. 
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0: 
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    else: 
+        return "%02d:%02d" % (minutes, seconds)
+
+def seconds_to_time(seconds): 
+    """
+    Returns a time object for durations under a day, and None otherwise. 
+    """
+    if seconds < (24 * 3600): 
+        return hms_to_time(0, 0, seconds)
+    else: 
+        return None
+
+def time_to_seconds(t): 
+    return (3600 * t.hour) + (60 * t.minute) + t.second
         
 def hms_to_time(hours, minutes, seconds):
     """
@@ -262,6 +374,21 @@ def hms_to_time(hours, minutes, seconds):
 
     return d
         
+@receiver(pre_save, sender=Run)
+def sync_run_seconds(sender, **kwargs): 
+    kwargs['instance'].sync_seconds()
+
+@receiver(pre_save, sender=Run)
+def set_run_metrics(sender, **kwargs): 
+    run = kwargs['instance']
+    # unless the caller already set them (with the profile it had at hand) 
+    if getattr(run, '_metrics_inputs', None) != run.metrics_inputs(): 
+        run.set_metrics()
+
+@receiver(pre_save, sender=Run)
+def set_run_fingerprint(sender, **kwargs): 
+    kwargs['instance'].set_fingerprint()
+
 @receiver(pre_delete, sender=Run)
 def update_on_run_delete(sender, **kwargs):
     """
@@ -292,7 +419,99 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 post_save.connect(create_user_profile, sender=User)
 
-class Aggregate(models.Model):
+class Job(models.Model): 
+    """
+    Work for the run_imports command, queued by the web process. The job is 
+    updated as it goes, so that one whose worker died can be told from a 
+    slow one. 
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), 
+        (FAILED, 'Failed'))
+
+    user = models.ForeignKey(User)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    message = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta: 
+        abstract = True
+
+class ImportJob(Job): 
+    """
+    An uploaded file of runs, saved to disk and waiting to be (or being) 
+    imported. The counts are updated as the import goes so the page can 
+    show its progress. 
+    """
+    path = models.CharField(max_length=255)
+    erase = models.BooleanField(default=False)
+    parsed = models.PositiveIntegerField(default=0)
+    inserted = models.PositiveIntegerField(default=0) # runs added, so far
+    failed = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return "Import %d for %s (%s)" % (self.id, self.user, self.status)
+
+    def progress(self): 
+        return {'status': self.status, 
+            'parsed': self.parsed, 
+            'inserted': self.inserted, 
+            'failed': self.failed, 
+            'message': self.message}
+
+class RecalcJob(Job): 
+    """
+    A recalculation of a user's runs after changes to the profile inputs 
+    named (space-separated) in changed. 
+    """
+    changed = models.CharField(max_length=100)
+
+    def __unicode__(self):
+        return "Recalculation %d for %s (%s)" % (self.id, self.user, self.status)
+
+SUMMED_FIELDS = ('count', 'duration', 'distance', 'calories', 
+    'hr_distance', 'hr_duration', 'beat_seconds')
+
+class RunTotals(object): 
+    """
+    The running totals (SUMMED_FIELDS, with the minimum and maximum 
+    distance) shared by Aggregate and DailySummary. 
+    """
+    def add_run(self, run): 
+        if self.count == 0 or run.distance < self.minimum: 
+            self.minimum = run.distance
+        if self.count == 0 or run.distance > self.maximum: 
+            self.maximum = run.distance
+
+        self.count += 1
+        self.duration += run.duration_in_seconds()
+        self.distance += run.distance
+        self.calories += (run.calories or 0)
+        if run.average_heart_rate: 
+            self.hr_distance += run.distance
+            self.hr_duration += run.duration_in_seconds()
+            self.beat_seconds += run.beat_seconds()
+            
+    def add_summary(self, summary): 
+        """
+        Adds the totals of a DailySummary (or an aggregate) to this one. 
+        """
+        if not summary.count: 
+            return
+        if self.count == 0 or summary.minimum < self.minimum: 
+            self.minimum = summary.minimum
+        if self.count == 0 or summary.maximum > self.maximum: 
+            self.maximum = summary.maximum
+
+        for field in SUMMED_FIELDS: 
+            setattr(self, field, getattr(self, field) + getattr(summary, field))
+
+class Aggregate(RunTotals, models.Model):
     user = models.ForeignKey(User,null=True)
     first_date = models.DateField()
     last_date = models.DateField()
@@ -306,7 +525,21 @@ class Aggregate(models.Model):
     efficiency = models.DecimalField(max_digits=5,decimal_places=3,blank=True, null=True)
     heart_rate = models.IntegerField(blank=True, null=True)
     beats_per_second = models.DecimalField(max_digits=5,decimal_places=3,blank=True, null=True)
-        
+    
+    # running totals from which the fields above are derived
+    count = models.PositiveIntegerField(default=0)
+    duration = models.PositiveIntegerField(default=0)
+    hr_distance = models.DecimalField(max_digits=9,decimal_places=3,default=0)
+    hr_duration = models.PositiveIntegerField(default=0)
+    beat_seconds = models.BigIntegerField(default=0) # heartbeats * 60
+
+    objects = UserRowsManager()
+
+    class Meta: 
+        # also indexes the lookups by user and period; the all-users rows 
+        # (user is NULL) are kept unique by an index in sql/aggregate.sql
+        unique_together = ('user', 'first_date', 'last_date')
+
     def __unicode__(self):
         if self.user: 
             username = self.user.username
@@ -314,4 +547,345 @@ class Aggregate(models.Model):
             username = None
         return "%s: %s - %s" % (username, self.first_date, self.last_date)
     
+    def remove_run(self, run): 
+        """
+        Removes a run previously added to this aggregate. Returns False if the 
+        aggregate can't be updated in place because the run was its minimum 
+        or maximum, in which case it needs to be recomputed from scratch. 
+        """
+        if self.count <= 1: 
+            self.count = 0
+            self.duration = 0
+            self.distance = 0
+            self.calories = 0
+            self.hr_distance = 0
+            self.hr_duration = 0
+            self.beat_seconds = 0
+            self.minimum = 0
+            self.maximum = 0
+            return True
+        
+        if run.distance == self.minimum or run.distance == self.maximum: 
+            return False
+
+        self.count -= 1
+        self.duration -= run.duration_in_seconds()
+        self.distance -= run.distance
+        self.calories = max(0, self.calories - (run.calories or 0))
+        if run.average_heart_rate: 
+            self.hr_duration -= run.duration_in_seconds()
+            self.hr_distance -= run.distance
+            self.beat_seconds -= run.beat_seconds()
+        return True
+        
+    def update_derived(self): 
+        """
+        Recomputes pace, speed, heart rate, etc. from the running totals. 
+        """
+        if self.duration > 0: 
+            self.speed = (self.distance * meters_per_mile) / self.duration
+        else: 
+            self.speed = None
+        
+        if self.count > 0: 
+            self.average = self.distance / self.count
+        else: 
+            self.average = 0
+            
+        heartbeats = Decimal(self.beat_seconds) / 60
+        if self.hr_duration > 0: 
+            self.beats_per_second = (heartbeats / self.hr_duration)
+            self.heart_rate = self.beats_per_second * 60
+        else: 
+            self.heart_rate = None
+            self.beats_per_second = None
+            
+        efficiency = Run.compute_efficiency(self.hr_distance * meters_per_mile, 
+            heartbeats)
+        if efficiency > 0: 
+            self.efficiency = efficiency
+        else: 
+            self.efficiency = None
+            
+        self.pace = Run.compute_pace(self.duration, self.distance)
+
+class DailySummary(RunTotals, models.Model):
+    """
+    Totals of a user's runs on a single day, kept up to date by the Run save 
+    and delete signals. Period aggregates are summed from these rather than 
+    from the runs themselves. 
+    
+    Each row also carries the running (cumulative) totals of all the user's 
+    days up to and including this one, so the totals for any range of days 
+    are the difference of two rows. 
     
+    Rows with user == None hold the totals of all users for that day, summed 
+    from the per-user rows. 
+    """
+    user = models.ForeignKey(User,null=True)
+    date = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+    duration = models.PositiveIntegerField(default=0)
+    distance = models.DecimalField(max_digits=9,decimal_places=3,default=0)
+    calories = models.PositiveIntegerField(default=0)
+    minimum = models.DecimalField(max_digits=9,decimal_places=3,default=0)
+    maximum = models.DecimalField(max_digits=9,decimal_places=3,default=0)
+    hr_distance = models.DecimalField(max_digits=9,decimal_places=3,default=0)
+    hr_duration = models.PositiveIntegerField(default=0)
+    beat_seconds = models.BigIntegerField(default=0) # heartbeats * 60
+    
+    cum_count = models.PositiveIntegerField(default=0)
+    cum_duration = models.BigIntegerField(default=0)
+    cum_distance = models.DecimalField(max_digits=12,decimal_places=3,default=0)
+    cum_calories = models.BigIntegerField(default=0)
+    cum_hr_distance = models.DecimalField(max_digits=12,decimal_places=3,default=0)
+    cum_hr_duration = models.BigIntegerField(default=0)
+    cum_beat_seconds = models.BigIntegerField(default=0)
+
+    objects = UserRowsManager()
+    
+    class Meta: 
+        unique_together = ('user', 'date')
+
+    def __unicode__(self):
+        return "%s: %s (%d runs)" % (self.user_id, self.date, self.count)
+        
+    def totals_since(self, earlier): 
+        """
+        Returns an unsaved DailySummary holding the totals of the days after 
+        earlier (which may be None) up to and including this one. Its minimum 
+        and maximum are not set. 
+        """
+        totals = DailySummary(user_id=self.user_id, date=self.date)
+        for field in SUMMED_FIELDS: 
+            total = getattr(self, 'cum_' + field)
+            if earlier: 
+                total -= getattr(earlier, 'cum_' + field)
+            model_field = self._meta.get_field(field)
+            if isinstance(model_field, models.DecimalField): 
+                # some backends accumulate the running totals as floats
+                total = Decimal(total).quantize(
+                    decimal.Decimal(10) ** -model_field.decimal_places)
+            setattr(totals, field, total)
+        return totals
+
+    @staticmethod
+    def claim(user_id, date): 
+        """
+        Returns the user's summary for the day, locked until the transaction 
+        ends. If there isn't one, an empty one is inserted to hold the day; 
+        the unique constraints (sql/dailysummary.sql for the all-users rows) 
+        make a concurrent insert wait for this transaction and then fail. 
+        """
+        summaries = DailySummary.objects.for_user(user_id).select_for_update()
+        try: 
+            return summaries.get(date=date)
+        except DailySummary.DoesNotExist: 
+            pass
+        sid = transaction.savepoint()
+        try: 
+            summary = DailySummary.objects.create(user_id=user_id, date=date)
+        except IntegrityError: 
+            transaction.savepoint_rollback(sid)
+            return summaries.get(date=date)
+        transaction.savepoint_commit(sid)
+        return summary
+
+    @staticmethod
+    def rebuild(user_id, date): 
+        """
+        Recomputes the summary for one user and day from that day's runs (or, 
+        if user_id is None, from all users' summaries for the day), and shifts 
+        the running totals of the later days by the difference. The day is 
+        claimed before anything is read, so concurrent rebuilds of it (as of 
+        the all-users rows, on every run save) take turns instead of both 
+        inserting the row or both shifting the later days. 
+        """
+        summary = DailySummary.claim(user_id, date)
+        fresh = DailySummary(user_id=user_id, date=date)
+        if user_id: 
+            for run in Run.objects.filter(user=user_id, date=date): 
+                fresh.add_run(run)
+        else: 
+            for other in DailySummary.objects.filter(user__isnull=False, date=date): 
+                fresh.add_summary(other)
+            
+        deltas = dict(('cum_' + field, F('cum_' + field) + 
+            (getattr(fresh, field) - getattr(summary, field))) 
+            for field in SUMMED_FIELDS)
+        (DailySummary.objects.for_user(user_id).filter(date__gt=date)
+            .update(**deltas))
+
+        if fresh.count: 
+            previous = (DailySummary.objects.for_user(user_id).filter(date__lt=date)
+                .order_by('-date')[:1])
+            for field in SUMMED_FIELDS: 
+                total = getattr(fresh, field)
+                if previous: 
+                    total += getattr(previous[0], 'cum_' + field)
+                setattr(fresh, 'cum_' + field, total)
+            fresh.id = summary.id
+            fresh.save()
+        else: 
+            fresh = None
+            summary.delete()
+
+        # after the write, so a reader in between can't cache the old days
+        cache.delete(extrema_cache_key(user_id))
+        return fresh
+
+    @staticmethod
+    def rebuild_from(user_id, first_day): 
+        """
+        Recomputes all of the user's summaries from first_day on (or, if 
+        user_id is None, the all-users summaries) in one pass, replacing the 
+        existing rows. Used after runs are inserted or deleted in bulk, when 
+        the save and delete signals don't fire. 
+        """
+        days = {}
+        if user_id: 
+            for run in Run.objects.filter(user=user_id, date__gte=first_day): 
+                days.setdefault(run.date, DailySummary(user_id=user_id, 
+                    date=run.date)).add_run(run)
+        else: 
+            for other in DailySummary.objects.filter(user__isnull=False, 
+                    date__gte=first_day): 
+                days.setdefault(other.date, DailySummary(user_id=None, 
+                    date=other.date)).add_summary(other)
+        
+        previous = (DailySummary.objects.for_user(user_id)
+            .filter(date__lt=first_day).order_by('-date')[:1])
+        totals = dict((field, 0) for field in SUMMED_FIELDS)
+        if previous: 
+            for field in SUMMED_FIELDS: 
+                totals[field] = getattr(previous[0], 'cum_' + field)
+
+        summaries = []
+        for day in sorted(days): 
+            summary = days[day]
+            for field in SUMMED_FIELDS: 
+                totals[field] += getattr(summary, field)
+                setattr(summary, 'cum_' + field, totals[field])
+            summaries.append(summary)
+
+        DailySummary.objects.for_user(user_id).filter(date__gte=first_day).delete()
+        bulk_create(DailySummary, summaries)
+        cache.delete(extrema_cache_key(user_id))
+        return len(summaries)
+
+    @staticmethod
+    def apply_deltas(user_id, deltas): 
+        """
+        Adds changes to the summed fields of the user's existing summaries, 
+        and shifts the running totals to match. deltas maps each day to a 
+        dict of field changes, e.g. {'calories': -20}. This is one query and 
+        one bulk update however many days change; minimum and maximum are 
+        left alone. 
+        """
+        if not deltas: 
+            return
+        fields = sorted(set(field for changes in deltas.values() 
+            for field in changes))
+        columns = fields + ['cum_' + field for field in fields]
+        
+        rows = []
+        shift = dict((field, 0) for field in fields)
+        summaries = (DailySummary.objects.for_user(user_id)
+            .filter(date__gte=min(deltas)).order_by('date')
+            .values_list('id', 'date', *columns))
+        for row in summaries: 
+            values = dict(zip(columns, row[2:]))
+            for (field, delta) in deltas.get(row[1], {}).items(): 
+                values[field] += delta
+                shift[field] += delta
+            for field in fields: 
+                values['cum_' + field] += shift[field]
+            rows.append((row[0], tuple(values[column] for column in columns)))
+        bulk_update(DailySummary, columns, rows)
+
+    @staticmethod
+    def range_totals(user_id, first_day, last_day): 
+        """
+        Returns an unsaved DailySummary with the user's totals from first_day 
+        to last_day, including minimum and maximum, in a constant number of 
+        lookups. Returns None if the user didn't run in that range. 
+        """
+        summaries = DailySummary.objects.for_user(user_id)
+        upper = summaries.filter(date__lte=last_day).order_by('-date')[:1]
+        if not upper or upper[0].date < first_day: 
+            return None
+        lower = summaries.filter(date__lt=first_day).order_by('-date')[:1]
+        if lower: 
+            totals = upper[0].totals_since(lower[0])
+        else: 
+            totals = upper[0].totals_since(None)
+        
+        extrema = get_extrema(user_id).query(first_day, last_day)
+        if extrema is None: 
+            # cached from before these days were summarized
+            extrema = get_extrema(user_id, refresh=True).query(first_day, last_day)
+        if extrema is None: 
+            # and changed again since
+            bounds = (summaries.filter(date__gte=first_day, date__lte=last_day)
+                .aggregate(Min('minimum'), Max('maximum')))
+            totals.minimum = bounds['minimum__min'] or 0
+            totals.maximum = bounds['maximum__max'] or 0
+        else: 
+            (lo, hi) = extrema
+            totals.minimum = Decimal(lo) / 1000
+            totals.maximum = Decimal(hi) / 1000
+        return totals
+
+def extrema_cache_key(user_id): 
+    if user_id: 
+        return "EXTREMA_%d" % user_id
+    else: 
+        return "EXTREMA_ALL"
+
+def get_extrema(user_id, refresh=False): 
+    """
+    Range minimum/maximum index over the user's daily summaries, rebuilt 
+    from them if refresh is True. 
+    """
+    key = extrema_cache_key(user_id)
+    extrema = None
+    if not refresh: 
+        extrema = cache.get(key)
+    if extrema is None: 
+        rows = (DailySummary.objects.for_user(user_id).order_by('date')
+            .values_list('date', 'minimum', 'maximum'))
+        extrema = DateRangeExtrema(rows)
+        cache.set(key, extrema)
+    return extrema
+
+@receiver(pre_save, sender=Run)
+def remember_run_day(sender, **kwargs): 
+    """
+    Remembers the day a run was previously saved under, in case the save 
+    moves it to a different day (or user). 
+    """
+    run = kwargs['instance']
+    run._previous_day = None
+    if run.id: 
+        try: 
+            old = Run.objects.filter(id=run.id).values('user', 'date')[0]
+            run._previous_day = (old['user'], old['date'])
+        except IndexError: 
+            pass
+            
+@receiver(post_save, sender=Run)
+def update_summary_on_run_save(sender, **kwargs): 
+    run = kwargs['instance']
+    day = (run.user_id, run.date)
+    previous = getattr(run, '_previous_day', None)
+    if previous and previous != day: 
+        DailySummary.rebuild(*previous)
+        DailySummary.rebuild(None, previous[1])
+    DailySummary.rebuild(*day)
+    DailySummary.rebuild(None, run.date)
+
+@receiver(post_delete, sender=Run)
+def update_summary_on_run_delete(sender, **kwargs): 
+    run = kwargs['instance']
+    DailySummary.rebuild(run.user_id, run.date)
+    DailySummary.rebuild(None, run.date)
@@ -0,0 +1,29 @@
+"""
+Runs the tasks of the batch commands (a user at a time) in a pool of
+processes.
+"""
+from multiprocessing import Pool
+
+from django.db import connection
+
+def _call(args):
+    # Pool.map passes a single argument
+    (func, task) = args
+    return func(*task)
+
+def map_tasks(func, tasks, jobs=1):
+    """
+    Returns func(*task) for each of the tasks, in order, calling it in up
+    to `jobs` processes at a time. func must be defined at the top level of
+    a module, so that the processes can find it.
+    """
+    if jobs > 1 and len(tasks) > 1:
+        # the children must not share the parent's database connection
+        connection.close()
+        pool = Pool(min(jobs, len(tasks)))
+        try:
+            return pool.map(_call, [(func, task) for task in tasks])
+        finally:
+            pool.close()
+            pool.join()
+    return [func(*task) for task in tasks]
@@ -0,0 +1,182 @@
+"""
+Per-request performance counters. PerfMiddleware starts a set of counters
+for each request; the database cursors, the cache and the aggregate code add
+to them as the request is handled, and the totals go out in a Server-Timing
+header and a log line. Outside of a request (or a collecting() block),
+counting does nothing.
+"""
+import logging, threading, time
+from contextlib import contextmanager
+
+from django import shortcuts
+from django.conf import settings
+from django.db import connections
+from django.db.backends.util import CursorWrapper
+
+log = logging.getLogger(__name__)
+
+# requests slower than this are logged as warnings
+DEFAULT_BUDGET_MS = 500
+
+_local = threading.local()
+
+class RequestStats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.counts = {}
+        self.times = {} # in seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0) + seconds
+
+    def get(self, name):
+        return self.counts.get(name, 0)
+
+    def ms(self, name):
+        return 1000 * self.times.get(name, 0)
+
+    def total_ms(self):
+        return 1000 * (time.time() - self.started)
+
+def current():
+    return getattr(_local, 'stats', None)
+
+def count(name, n=1):
+    stats = current()
+    if stats:
+        stats.count(name, n)
+
+@contextmanager
+def timer(name):
+    """
+    Adds the time spent in the block to the named timer. Nested blocks for
+    the same timer only count once.
+    """
+    stats = current()
+    depth = getattr(_local, name + '_depth', 0)
+    if stats is None or depth:
+        yield
+        return
+    setattr(_local, name + '_depth', 1)
+    start = time.time()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.time() - start)
+        setattr(_local, name + '_depth', 0)
+
+@contextmanager
+def collecting():
+    """
+    Counts as PerfMiddleware does, for code run outside of a request (such
+    as a management command or a benchmark). Yields the RequestStats.
+    """
+    for connection in connections.all():
+        time_queries(connection)
+    previous = current()
+    _local.stats = RequestStats()
+    try:
+        yield _local.stats
+    finally:
+        _local.stats = previous
+
+def render_to_response(*args, **kwargs):
+    """
+    django.shortcuts.render_to_response, timed as template rendering.
+    """
+    with timer('render'):
+        return shortcuts.render_to_response(*args, **kwargs)
+
+class TimingCursor(CursorWrapper):
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.record(start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.record(start)
+
+    def record(self, start):
+        stats = current()
+        if stats:
+            stats.count('db')
+            stats.add_time('db', time.time() - start)
+
+def time_queries(connection):
+    """
+    Wraps the connection's cursors (debug or not) so that every query is
+    counted. Each thread has its own connection, so this is done as each
+    request starts.
+    """
+    if getattr(connection, 'timed', False):
+        return
+    cursor = connection.cursor
+    connection.cursor = lambda: TimingCursor(cursor(), connection)
+    connection.timed = True
+
+def server_timing(stats):
+    """
+    The Server-Timing header value, e.g.
+    db;desc="12 queries";dur=3.1, cache;desc="8 gets, 6 hits, ...", ...
+    """
+    metrics = [
+        'db;desc="%d queries";dur=%.1f' % (stats.get('db'), stats.ms('db')),
+        'cache;desc="%d gets, %d hits, %d misses, %d sets, %d local hits"' % (
+            stats.get('cache_gets'), stats.get('cache_hits'),
+            stats.get('cache_misses'), stats.get('cache_sets'),
+            stats.get('local_hits')),
+        'agg;desc="%d recomputed"' % stats.get('aggregates'),
+        'render;dur=%.1f' % stats.ms('render'),
+        'total;dur=%.1f' % stats.total_ms(),
+    ]
+    return ', '.join(metrics)
+
+class PerfMiddleware(object):
+    """
+    Counts SQL queries and their time, shared cache gets (with hits and
+    misses) and sets, hits in the per-process cache, aggregate recomputes,
+    template rendering time and the total time of each request. Should come
+    first, so that the total takes in the other middleware. For a streamed
+    response only the time until the view returns is counted.
+    """
+    def process_request(self, request):
+        for connection in connections.all():
+            time_queries(connection)
+        _local.stats = RequestStats()
+        _local.view = None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _local.view = getattr(view_func, '__name__', repr(view_func))
+
+    def process_response(self, request, response):
+        stats = current()
+        if stats is None:
+            return response
+        _local.stats = None
+
+        response['Server-Timing'] = server_timing(stats)
+        total = stats.total_ms()
+        budget = getattr(settings, 'RUN_PERF_BUDGET_MS', DEFAULT_BUDGET_MS)
+        if total > budget:
+            level = logging.WARNING
+        else:
+            level = logging.INFO
+        log.log(level, "perf method=%s path=%s view=%s status=%d total_ms=%.1f "
+            "db_queries=%d db_ms=%.1f cache_gets=%d cache_hits=%d "
+            "cache_misses=%d cache_sets=%d local_hits=%d aggregates=%d "
+            "render_ms=%.1f" % (
+            request.method, request.path, _local.view, response.status_code,
+            total, stats.get('db'), stats.ms('db'), stats.get('cache_gets'),
+            stats.get('cache_hits'), stats.get('cache_misses'),
+            stats.get('cache_sets'), stats.get('local_hits'),
+            stats.get('aggregates'), stats.ms('render')))
+        return response
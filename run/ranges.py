@@ -0,0 +1,54 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+class SparseTable(object):
+    """
+    Answers minimum (or maximum) queries over any slice of a fixed list of
+    integers in constant time, after O(n log n) preprocessing.
+    """
+    def __init__(self, values, func=min):
+        self.func = func
+        level = array('i', values)
+        self.levels = [level]
+        width = 1
+        while 2 * width <= len(level):
+            previous = level
+            level = array('i', [func(previous[i], previous[i + width])
+                for i in xrange(len(previous) - width)])
+            self.levels.append(level)
+            width *= 2
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def query(self, i, j):
+        """
+        Returns func of values[i] through values[j], inclusive.
+        """
+        k = (j - i + 1).bit_length() - 1
+        level = self.levels[k]
+        return self.func(level[i], level[j - (1 << k) + 1])
+
+class DateRangeExtrema(object):
+    """
+    Minimum and maximum of per-day values over any range of dates. Values are
+    stored as integer thousandths to keep the tables small when cached.
+    """
+    def __init__(self, rows):
+        """
+        rows is a date-ordered sequence of (date, minimum, maximum) tuples.
+        """
+        self.ordinals = array('i', [day.toordinal() for (day, lo, hi) in rows])
+        self.minima = SparseTable([int(lo * 1000) for (day, lo, hi) in rows], min)
+        self.maxima = SparseTable([int(hi * 1000) for (day, lo, hi) in rows], max)
+
+    def query(self, first_day, last_day):
+        """
+        Returns (minimum, maximum) in thousandths for the days from first_day
+        to last_day inclusive, or None if there are no days in that range.
+        """
+        i = bisect_left(self.ordinals, first_day.toordinal())
+        j = bisect_right(self.ordinals, last_day.toordinal()) - 1
+        if i > j:
+            return None
+        return (self.minima.query(i, j), self.maxima.query(i, j))
@@ -0,0 +1,144 @@
+"""
+Recomputes the profile-dependent fields of runs (calories, heart rate zone
+and the derived metrics) a user at a time, in chunks, with one profile
+lookup per user and one bulk UPDATE per chunk. Only calories that were
+estimated (or are missing) are recomputed, not ones that came with the run.
+Save signals are bypassed, so the daily summaries are adjusted here; callers
+should invalidate the cached aggregates for the days returned.
+"""
+import logging
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from run.bulk import bulk_update
+from run.models import Run, DailySummary
+from run.parallel import map_tasks
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+
+METRICS = ('pace', 'speed', 'heartbeats', 'efficiency', 'heart_rate_percent')
+FIELDS = ('calories', 'zone') + METRICS
+
+# the profile fields that the run fields above depend on
+PROFILE_INPUTS = ('weight', 'birthday', 'gender', 'resting_heart_rate')
+
+def profile_inputs(profile): 
+    # forms may leave strings on the instance, e.g. the weight
+    return dict((field, profile._meta.get_field(field).to_python(
+        getattr(profile, field))) for field in PROFILE_INPUTS)
+
+def changed_inputs(before, profile): 
+    """
+    Returns the set of profile inputs that differ from the before snapshot 
+    taken with profile_inputs. 
+    """
+    after = profile_inputs(profile)
+    return set(field for field in PROFILE_INPUTS if after[field] != before[field])
+
+def affected_fields(changed): 
+    """
+    Returns (fields, only_heart_rate): the run fields that depend on the 
+    changed profile inputs, and whether only runs with a heart rate can be 
+    affected. Without a heart rate, calories depend on the weight alone. 
+    """
+    fields = set()
+    only_heart_rate = True
+    if 'weight' in changed: 
+        fields.add('calories')
+        only_heart_rate = False
+    if changed & set(['birthday', 'gender', 'resting_heart_rate']): 
+        fields.update(['calories', 'zone'])
+    if changed & set(['birthday', 'gender']): 
+        fields.add('heart_rate_percent') # via the maximum heart rate
+    return (tuple(field for field in FIELDS if field in fields), only_heart_rate)
+
+def prepared(run, fields): 
+    # compare as stored, so decimals that only differ past their places don't count
+    return [Run._meta.get_field(field).get_db_prep_save(getattr(run, field), 
+        connection=connection) for field in fields]
+
+def compute(run, fields, profile):
+    if 'calories' in fields and (run.calories_estimated or not run.calories):
+        run.set_calories(profile)
+    if 'zone' in fields:
+        run.set_zone(profile)
+    if set(fields) & set(METRICS):
+        run.set_metrics(profile)
+    if 'fingerprint' in fields:
+        run.set_fingerprint()
+
+def recalculate_user(user_id, fields=FIELDS, chunk_size=CHUNK_SIZE, 
+        only_heart_rate=False):
+    """
+    Recomputes the given fields for all of a user's runs (or just those with 
+    a heart rate) and updates the user's daily summaries to match. Returns 
+    (number of runs changed, dict mapping each day whose calories changed to 
+    the change).
+    """
+    user = User.objects.get(id=user_id)
+    profile = user.get_profile()
+    changed = 0
+    deltas = {}
+
+    columns = tuple(fields)
+    if 'calories' in fields:
+        columns += ('calories_estimated',) # as set_calories sets it
+
+    all_runs = Run.objects.filter(user=user_id)
+    if only_heart_rate: 
+        all_runs = all_runs.filter(average_heart_rate__gt=0)
+
+    last_id = 0
+    while True:
+        runs = list(all_runs.filter(id__gt=last_id).order_by('id')[:chunk_size])
+        if not runs:
+            break
+        last_id = runs[-1].id
+
+        rows = []
+        for run in runs:
+            run.user = user
+            calories = run.calories
+            before = prepared(run, columns)
+            compute(run, fields, profile)
+            if prepared(run, columns) != before:
+                rows.append((run.id, tuple(getattr(run, column) for column in columns)))
+            if 'calories' in fields:
+                delta = (run.calories or 0) - (calories or 0)
+                if delta:
+                    deltas[run.date] = deltas.get(run.date, 0) + delta
+
+        with transaction.commit_on_success():
+            changed += bulk_update(Run, columns, rows)
+
+    with transaction.commit_on_success():
+        DailySummary.apply_deltas(user_id, dict((day, {'calories': delta})
+            for (day, delta) in deltas.items()))
+    log.info("Recalculated %s for user %d: %d runs changed" %
+        (", ".join(fields), user_id, changed))
+    return (changed, deltas)
+
+def recalculate(user_ids, fields=FIELDS, jobs=1, chunk_size=CHUNK_SIZE, 
+        only_heart_rate=False):
+    """
+    Recomputes the given fields for the runs of each of the users, with up
+    to `jobs` users at a time in separate processes, then updates the
+    all-users daily summaries once. Returns a dict mapping each user id to
+    the (changed, deltas) result of recalculate_user.
+    """
+    tasks = [(user_id, tuple(fields), chunk_size, only_heart_rate) 
+        for user_id in user_ids]
+    results = map_tasks(recalculate_user, tasks, jobs)
+
+    everyone = {}
+    for (changed, deltas) in results:
+        for (day, delta) in deltas.items():
+            everyone[day] = everyone.get(day, 0) + delta
+    with transaction.commit_on_success():
+        DailySummary.apply_deltas(None, dict((day, {'calories': delta})
+            for (day, delta) in everyone.items()))
+
+    return dict(zip(user_ids, results))
@@ -0,0 +1,198 @@
+"""
+Parsers for the files that runs can be imported from. Each source reads a
+file one record at a time and turns each record into a normalized dict
+(date, seconds, distance in miles, average_heart_rate and calories), from
+which an unsaved Run is made. detect() works out which source a file is.
+"""
+import csv, datetime, json
+from decimal import Decimal
+
+from run.jsonstream import ArrayReader
+from run.models import Run
+
+METERS_PER_MILE = 1609.344
+
+# bytes read to work out a file's format
+SNIFF_SIZE = 4096
+
+class UnknownFormat(ValueError):
+    pass
+
+def make_run(record):
+    run = Run()
+    run.date = record['date']
+    run.set_duration(0, 0, record['seconds'])
+    run.distance = record['distance']
+    run.average_heart_rate = record.get('average_heart_rate')
+    run.calories = record.get('calories')
+    return run
+
+def optional_int(value):
+    if value in (None, ''):
+        return None
+    return int(value)
+
+class Source(object):
+    """
+    The runs in a file, parsed one record at a time as they are iterated
+    over. Records that can't be made into runs are skipped and listed in
+    errors as (index, offset, message); records of other activities are
+    just counted in ignored.
+
+    Subclasses define normalize(raw), which returns a record as a
+    normalized dict, or None if it isn't a run. By default each line of
+    the file is a record; a subclass can parse the lines into rows (e.g.
+    of CSV) by overriding rows, or replace records altogether.
+    """
+    name = None
+
+    def __init__(self, data_file):
+        self.data_file = data_file
+        self.errors = []
+        self.ignored = 0
+
+    def lines(self):
+        for line in self.data_file:
+            self.position += len(line)
+            yield line
+
+    def rows(self, lines):
+        return lines
+
+    def records(self):
+        """
+        Yields (index, offset, raw record) for each record in the file.
+        """
+        self.position = 0
+        offset = 0
+        for (index, row) in enumerate(self.rows(self.lines())):
+            yield (index, offset, row)
+            offset = self.position
+
+    def __iter__(self):
+        for (index, offset, raw) in self.records():
+            try:
+                record = self.normalize(raw)
+                if record is None:
+                    self.ignored += 1
+                    continue
+                run = make_run(record)
+            except Exception as e:
+                self.errors.append((index, offset, str(e)))
+                continue
+            yield run
+
+class ImportedRuns(Source):
+    """
+    The runs in a JSON list, as uploaded to the site and as exported by it.
+    A malformed file raises JSONStreamError part way through.
+    """
+    name = 'json'
+
+    def __init__(self, data_file):
+        Source.__init__(self, data_file)
+        self.reader = ArrayReader(data_file)
+
+    def records(self):
+        return iter(self.reader)
+
+    def normalize(self, obj):
+        return {'date': datetime.datetime.strptime(obj[u'date'], "%Y-%m-%d").date(),
+            'seconds': int(obj[u'duration']),
+            'distance': float(obj[u'distance']) / METERS_PER_MILE,
+            'average_heart_rate': optional_int(obj[u'average_heart_rate'] or None),
+            'calories': optional_int(obj[u'calories'] or None)}
+
+class DailyMileJSON(Source):
+    """
+    A DailyMile export with a JSON object on each line.
+    """
+    name = 'dailymile-json'
+
+    def normalize(self, line):
+        obj = json.loads(line)
+        if obj[u'workout_type'] != u'Running':
+            return None
+        return {'date': datetime.datetime.strptime(obj[u'date'], "%m/%d/%y").date(),
+            'seconds': int(obj[u'duration']),
+            'distance': float(obj[u'distance']),
+            'average_heart_rate': optional_int(obj[u'hr_avg'])}
+
+class DailyMileCSV(Source):
+    """
+    A DailyMile CSV export: date, activity, meters, seconds, ...
+    """
+    name = 'dailymile-csv'
+
+    def rows(self, lines):
+        return csv.reader(lines, dialect=csv.excel)
+
+    def normalize(self, row):
+        if row[1] != "Running":
+            return None
+        return {'date': datetime.datetime.strptime(row[0], "%m/%d/%Y").date(),
+            'seconds': int(row[3]),
+            'distance': float(row[2]) / METERS_PER_MILE}
+
+class FlotrackCSV(Source):
+    """
+    A Flotrack CSV export (or a CSV export from this site): date, minutes,
+    seconds, miles, pace, heart rate, calories. A header line is skipped.
+    """
+    name = 'flotrack'
+
+    def rows(self, lines):
+        return csv.reader(lines, dialect=csv.excel)
+
+    def normalize(self, row):
+        if row[0] == 'Date':
+            return None
+        minutes = int(row[1])
+        return {'date': datetime.datetime.strptime(row[0], "%b %d, %Y").date(),
+            'seconds': 60 * minutes + int(row[2]),
+            'distance': Decimal(row[3]),
+            'average_heart_rate': optional_int(row[5]),
+            'calories': optional_int(row[6])}
+
+SOURCES = dict((source.name, source) for source in
+    (ImportedRuns, DailyMileJSON, DailyMileCSV, FlotrackCSV))
+
+def parses(pattern, value):
+    try:
+        datetime.datetime.strptime(value, pattern)
+    except ValueError:
+        return False
+    return True
+
+def detect(data_file):
+    """
+    Works out the format of a file from its first few lines and returns the
+    name of its source. The file is left at the start.
+    """
+    head = data_file.read(SNIFF_SIZE)
+    data_file.seek(0)
+    start = head.lstrip()[:1]
+    if start == '[':
+        return ImportedRuns.name
+    elif start == '{':
+        return DailyMileJSON.name
+
+    lines = head.splitlines()[:-1] or head.splitlines()
+    for row in csv.reader(lines, dialect=csv.excel):
+        if not row:
+            continue
+        elif parses("%b %d, %Y", row[0]) or row[:2] == ['Date', 'Minutes']:
+            return FlotrackCSV.name
+        elif parses("%m/%d/%Y", row[0]):
+            return DailyMileCSV.name
+    raise UnknownFormat("Unknown import file format")
+
+def open_source(data_file, format=None):
+    """
+    The source for a file, of the given format or else the one detected.
+    """
+    if format is None:
+        format = detect(data_file)
+    elif format not in SOURCES:
+        raise UnknownFormat("Unknown import file format: %s" % format)
+    return SOURCES[format](data_file)
@@ -0,0 +1,7 @@
+-- Run after the run_aggregate table is created by syncdb; upgrade_schema adds
+-- whatever is missing to existing databases.
+
+-- save_aggregate relies on an IntegrityError to find that another request
+-- stored the same period first. For the all-users rows user_id is NULL, and
+-- NULLs never collide in the (user, first_date, last_date) constraint.
+CREATE UNIQUE INDEX run_aggregate_all_period ON run_aggregate (first_date, last_date) WHERE user_id IS NULL;
@@ -0,0 +1,7 @@
+-- Run after the run_dailysummary table is created by syncdb; upgrade_schema adds
+-- whatever is missing to existing databases.
+
+-- DailySummary.claim inserts a day's row and reads it back if the insert
+-- fails. The (user, date) constraint can't fail for the all-users days,
+-- whose user_id is NULL, so without this they could be inserted twice.
+CREATE UNIQUE INDEX run_dailysummary_all_date ON run_dailysummary (date) WHERE user_id IS NULL;
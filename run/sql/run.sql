@@ -0,0 +1,10 @@
+-- Run after the run_run table is created by syncdb; upgrade_schema adds
+-- whatever is missing to existing databases. Django 1.4 can only index
+-- single columns.
+
+-- a user's runs by date, as for the run lists, the summaries and the yield
+-- page (which also filters on the heart rate)
+CREATE INDEX run_run_user_date ON run_run (user_id, date, average_heart_rate);
+
+-- a user's runs by fingerprint, as when importing
+CREATE INDEX run_run_user_fingerprint ON run_run (user_id, fingerprint);
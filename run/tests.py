@@ -2,10 +2,29 @@
 This file demonstrates writing tests using the unittest module. These will pass
 when you run "manage.py test".
 
-Replace this with more appropriate tests for your application.
+The benchmark times the hot views against generated data. It only runs when
+RUN_BENCH is set, and is small by default; for numbers worth comparing, run
+it on its own with more data:
+
+    RUN_BENCH=1 RUN_BENCH_USERS=20 RUN_BENCH_YEARS=5 ./manage.py test run.Benchmark
+
+The table is printed to stderr, and also written as tab-separated values to
+the file named by RUN_BENCH_OUTPUT if that is set.
 """
+import datetime, json, os, random, re, shutil, sys, tempfile, time
+from decimal import Decimal
+from gzip import GzipFile
+from StringIO import StringIO
 
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.db.models import Sum
 from django.test import TestCase
+from django.utils.unittest import skipUnless
+
+from run import exporter, importer, localcache, models, perf, sources, views
+from run.models import Run, Shoe, Aggregate
 
 
 class SimpleTest(TestCase):
@@ -14,3 +33,548 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class ImportTest(TestCase):
+    def test_many_runs(self):
+        """
+        Imports more runs (and days) in one batch than SQLite allows in one
+        INSERT, twice a day for a year.
+        """
+        user = User.objects.create_user('importer', 'importer@example.com', 'pw')
+        profile = user.get_profile()
+        profile.weight = 150
+        profile.birthday = datetime.date(1980, 1, 1)
+        profile.save()
+        today = datetime.date.today()
+        runs = []
+        for d in range(365):
+            for n in range(2):
+                run = Run(date=today - datetime.timedelta(days=d), distance='3.10')
+                run.set_duration(0, 25, n)
+                runs.append(run)
+
+        (added, changed, span) = importer.import_runs(user, runs, everyone=False)
+        self.assertEqual((added, changed), (730, 0))
+        self.assertEqual(span, (today - datetime.timedelta(days=364), today))
+        self.assertEqual(Run.objects.filter(user=user).count(), 730)
+        summaries = models.DailySummary.objects.filter(user=user)
+        self.assertEqual(summaries.count(), 365)
+        self.assertEqual(summaries.get(date=today).cum_distance, 730 * Decimal('3.1'))
+
+    def test_round_trip(self):
+        """
+        Importing the site's own export again finds every run already there,
+        and leaves the estimated calories marked as such.
+        """
+        generate(users=1)
+        user = User.objects.get(username='bench0')
+        runs = Run.objects.filter(user=user)
+        estimated = runs.filter(calories_estimated=True).count()
+        self.assertTrue(estimated)
+
+        for serialize in (exporter.csv_rows, exporter.json_array):
+            data = StringIO(''.join(serialize(exporter.export_rows(user))))
+            (added, changed, span) = importer.import_runs(user,
+                sources.open_source(data))
+            self.assertEqual((added, changed, span), (0, 0, None))
+            self.assertEqual(runs.filter(calories_estimated=True).count(), estimated)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        generate(users=1)
+        self.user = User.objects.get(username='bench0')
+        self.assertTrue(self.client.login(username='bench0', password='pw'))
+
+    def test_export(self):
+        """
+        The streamed export has the same body with or without gzip.
+        """
+        runs = Run.objects.filter(user=self.user).count()
+        plain = self.client.get('/bench0/export')
+        self.assertEqual(plain.status_code, 200)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        body = plain.content
+        self.assertEqual(len(json.loads(body)), runs)
+
+        compressed = self.client.get('/bench0/export', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed.status_code, 200)
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(GzipFile(fileobj=StringIO(compressed.content)).read(), body)
+
+    def test_connection_closed(self):
+        """
+        The export closes the database connection it reads with once it is
+        sent. (Closing the test database's would lose it.)
+        """
+        closed = []
+        class Connection(object):
+            def close(self):
+                closed.append(True)
+        saved = exporter.connection
+        exporter.connection = Connection()
+        try:
+            response = self.client.get('/bench0/export')
+            self.assertFalse(closed)
+            self.assertTrue(response.content)
+            self.assertTrue(closed)
+        finally:
+            exporter.connection = saved
+
+
+class ProfileTest(TestCase):
+    def test_recalculation(self):
+        """
+        A profile change queues the recalculation, which the worker does.
+        """
+        generate(users=1)
+        self.assertTrue(self.client.login(username='bench0', password='pw'))
+        user = User.objects.get(username='bench0')
+        runs = Run.objects.filter(user=user)
+        before = list(runs.order_by('id').values_list('calories', flat=True))
+
+        response = self.client.post('/bench0/profile/update', {
+            'email': 'bench0@example.com', 'first_name': '', 'last_name': '',
+            'new_password1': '', 'new_password2': '', 'birthday': '01/01/1980',
+            'gender': 'False', 'weight': '250', 'resting_heart_rate': '55'})
+        self.assertEqual(response.status_code, 302)
+        job = models.RecalcJob.objects.get(user=user)
+        self.assertEqual(job.status, models.RecalcJob.QUEUED)
+        self.assertEqual(list(runs.order_by('id').values_list('calories',
+            flat=True)), before)
+
+        call_command('run_imports', once=True, stdout=StringIO())
+        self.assertEqual(models.RecalcJob.objects.get(id=job.id).status,
+            models.RecalcJob.DONE)
+        self.assertNotEqual(list(runs.order_by('id').values_list('calories',
+            flat=True)), before)
+        profile = user.get_profile()
+        for run in runs:
+            calories = run.calories
+            run.set_calories(profile)
+            self.assertEqual(run.calories, calories)
+        summed = models.DailySummary.objects.filter(user=user).aggregate(
+            Sum('calories'))
+        self.assertEqual(summed['calories__sum'], runs.aggregate(
+            Sum('calories'))['calories__sum'])
+
+
+class RangeTest(TestCase):
+    def test_range(self):
+        """
+        The totals for a range of days are those of the runs in it.
+        """
+        generate(users=1)
+        self.assertTrue(self.client.login(username='bench0', password='pw'))
+        today = datetime.date.today()
+        first = today - datetime.timedelta(days=100)
+        last = today - datetime.timedelta(days=30)
+
+        response = self.client.get('/bench0/range', {'first': str(first),
+            'last': str(last)})
+        self.assertEqual(response.status_code, 200)
+        totals = json.loads(response.content)
+        runs = Run.objects.filter(user__username='bench0', date__gte=first,
+            date__lte=last)
+        distances = [run.distance for run in runs]
+        self.assertEqual(totals['count'], len(distances))
+        self.assertEqual(totals['duration'], sum(run.seconds for run in runs))
+        self.assertEqual(Decimal(str(totals['distance'])), sum(distances))
+        self.assertEqual(Decimal(str(totals['minimum'])), min(distances))
+        self.assertEqual(Decimal(str(totals['maximum'])), max(distances))
+
+        response = self.client.get('/bench0/range', {'first': str(last),
+            'last': str(first)})
+        self.assertEqual(response.status_code, 400)
+
+
+class RunChangeTest(TestCase):
+    """
+    Adding, editing and removing runs keeps the stored aggregates, the
+    cached ones and the daily summaries equal to the sums of the runs.
+    """
+    def setUp(self):
+        generate(users=2)
+        (self.cache, self.restore) = use_locmem()
+        self.cache.clear() # the local-memory caches share their contents
+        self.assertTrue(self.client.login(username='bench0', password='pw'))
+        self.user = User.objects.get(username='bench0')
+        # stores the week and month aggregates for the user and for everyone
+        for url in ('/bench0/', '/_all/'):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.week = views.surrounding_week(datetime.date.today())
+        self.assertTrue(self.stored(self.week))
+
+    def tearDown(self):
+        self.restore()
+
+    def stored(self, period, user=None):
+        if user is None:
+            user = self.user
+        return Aggregate.objects.filter(user=user, first_date=period[0],
+            last_date=period[1]).exists()
+
+    def totals(self, runs):
+        runs = list(runs)
+        distances = [run.distance for run in runs]
+        with_hr = [run for run in runs if run.average_heart_rate]
+        return {'count': len(runs),
+            'duration': sum(run.duration_in_seconds() for run in runs),
+            'distance': sum(distances),
+            'calories': sum(run.calories or 0 for run in runs),
+            'minimum': min(distances or [0]),
+            'maximum': max(distances or [0]),
+            'hr_distance': sum(run.distance for run in with_hr),
+            'hr_duration': sum(run.duration_in_seconds() for run in with_hr),
+            'beat_seconds': sum(run.beat_seconds() for run in with_hr)}
+
+    def assertTotals(self, row, runs, message):
+        expected = self.totals(runs)
+        actual = dict((field, getattr(row, field)) for field in expected)
+        self.assertEqual(actual, expected, message)
+
+    def check(self):
+        for user in (self.user, None):
+            runs = Run.objects.all()
+            if user:
+                runs = runs.filter(user=user)
+
+            for ag in Aggregate.objects.for_user(user and user.id):
+                self.assertTotals(ag, runs.filter(date__gte=ag.first_date,
+                    date__lte=ag.last_date), ag)
+
+            if user:
+                prefix = views.WEEK_USER_AG_PREFIX
+            else:
+                prefix = views.WEEK_ALL_AG_PREFIX
+            ag = views.cache.get(views.ag_cache_key(prefix, user, self.week[0],
+                views.get_generation(user)))
+            if ag:
+                self.assertTotals(ag, runs.filter(date__gte=self.week[0],
+                    date__lte=self.week[1]), "cached %s" % ag)
+
+            summaries = models.DailySummary.objects.for_user(user and user.id)
+            self.assertEqual(sorted(summaries.values_list('date', flat=True)),
+                sorted(set(runs.values_list('date', flat=True))))
+            cumulative = dict((field, 0) for field in models.SUMMED_FIELDS)
+            for summary in summaries.order_by('date'):
+                day = runs.filter(date=summary.date)
+                self.assertTotals(summary, day, summary)
+                for field in models.SUMMED_FIELDS:
+                    cumulative[field] += getattr(summary, field)
+                    self.assertEqual(getattr(summary, 'cum_' + field),
+                        cumulative[field], "%s: cum_%s" % (summary, field))
+
+    def add(self, day, distance, seconds, heart_rate=''):
+        response = self.client.post('/bench0/run/add', {
+            'user': self.user.id, 'date': day.strftime("%m/%d/%Y"),
+            'date_month': day.month, 'date_day': day.day,
+            'date_year': day.year, 'duration_hours': seconds // 3600,
+            'duration_minutes': seconds // 60 % 60,
+            'duration_seconds': seconds % 60, 'distance': distance,
+            'average_heart_rate': heart_rate})
+        self.assertEqual(response.status_code, 302)
+        return Run.objects.filter(user=self.user).latest('id')
+
+    def remove(self, run):
+        response = self.client.get('/bench0/run/remove/%d' % run.id)
+        self.assertEqual(response.status_code, 302)
+
+    def test_add(self):
+        """
+        Added runs are added to the stored and cached aggregates in place.
+        """
+        self.add(self.week[0], '3.10', 1500, 150)
+        self.add(self.week[0], '30.00', 4 * 3600)
+        self.assertTrue(self.stored(self.week)) # updated in place
+        self.check()
+
+    def test_remove(self):
+        """
+        Removed runs are taken out in place, unless they were the minimum or
+        maximum, in which case the aggregate is recomputed on the next read.
+        """
+        runs = Run.objects.filter(user=self.user, date__gte=self.week[0],
+            date__lte=self.week[1]).order_by('distance')
+        self.assertTrue(runs.count() >= 3)
+        self.remove(runs[1])
+        self.assertTrue(self.stored(self.week))
+        self.check()
+
+        # the week's minimum and maximum can't be taken out in place
+        self.remove(runs[0])
+        self.assertFalse(self.stored(self.week))
+        self.check()
+        self.remove(runs.reverse()[0])
+        self.check()
+        self.assertEqual(self.client.get('/bench0/').status_code, 200)
+        self.assertTrue(self.stored(self.week))
+        self.check()
+
+    def test_remove_last(self):
+        """
+        Removing the only run of a day removes the day's summary.
+        """
+        day = views.surrounding_week(datetime.date.today() -
+            datetime.timedelta(days=400))[0]
+        run = self.add(day, '5.00', 2400)
+        self.check()
+        self.remove(run)
+        self.check()
+
+    def test_edit(self):
+        """
+        There is no view for editing a run; saving it (as the admin does)
+        moves its totals between the days' summaries, and the aggregates of
+        both days are then invalidated.
+        """
+        run = Run.objects.filter(user=self.user).order_by('-date')[0]
+        old_day = run.date
+        run.date -= datetime.timedelta(days=500)
+        run.distance = Decimal('7.77')
+        run.save()
+        views.invalidate_days(self.user, [old_day, run.date])
+        self.assertFalse(self.stored(self.week))
+        self.check()
+
+
+def generate(users=3, years=1, seed=1, today=None):
+    """
+    Creates users bench0, bench1, ... (all with the password 'pw'), each
+    with about a run a day for the given number of years before today. The
+    data only depends on the seed. Even-numbered users have complete
+    profiles and heart rates for most runs; odd-numbered users have no sex
+    or resting heart rate in their profiles and never a heart rate. Every
+    third user has a new pair of shoes every two months. Returns the users.
+    """
+    rand = random.Random(seed)
+    if today is None:
+        today = datetime.date.today()
+
+    created = []
+    for i in range(users):
+        user = User.objects.create_user('bench%d' % i, 'bench%d@example.com' % i, 'pw')
+        profile = user.get_profile()
+        profile.weight = rand.randint(110, 210)
+        profile.birthday = datetime.date(rand.randint(1950, 1995),
+            rand.randint(1, 12), rand.randint(1, 28))
+        if i % 2 == 0:
+            profile.gender = rand.random() < 0.5
+            profile.resting_heart_rate = rand.randint(42, 70)
+        profile.save()
+
+        shoes = []
+        if i % 3 == 0:
+            # few enough miles on each to fit in Shoe.miles
+            shoes = [Shoe.objects.create(user=user, make='Brand',
+                model='Model %d' % n, miles=0, active=(n == 0))
+                for n in range(years * 6 + 1)]
+
+        runs = []
+        for d in range(365 * years):
+            day = today - datetime.timedelta(days=d)
+            for n in range(rand.choice((0, 0, 1, 1, 1, 2))):
+                miles = rand.uniform(1, 14)
+                run = Run(date=day, distance='%.2f' % miles)
+                run.set_duration(0, 0, int(miles * rand.randint(390, 660)))
+                if i % 2 == 0 and rand.random() < 0.8:
+                    run.average_heart_rate = rand.randint(115, 180)
+                if shoes:
+                    run.shoe = shoes[d // 61]
+                runs.append(run)
+        importer.import_runs(user, runs)
+
+        for shoe in shoes:
+            worn = Run.objects.filter(shoe=shoe).aggregate(Sum('distance'))
+            shoe.miles = worn['distance__sum'] or 0
+            shoe.save()
+        created.append(user)
+    return created
+
+class CacheDownTest(TestCase):
+    def setUp(self):
+        generate(users=1)
+        dummy = get_cache('django.core.cache.backends.dummy.DummyCache')
+        self.saved = localcache.shared_cache.backend
+        localcache.shared_cache.backend = dummy
+        self.assertTrue(self.client.login(username='bench0', password='pw'))
+
+    def tearDown(self):
+        localcache.shared_cache.backend = self.saved
+
+    def test_pages(self):
+        """
+        The pages still work when the cache keeps nothing.
+        """
+        for url in ('/bench0/', '/_all/', '/bench0/history', '/bench0/yield'):
+            start = time.time()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertTrue(time.time() - start < views.LOCK_WAIT * views.LOCK_ATTEMPTS)
+
+def use_locmem():
+    """
+    Points everything that uses the shared cache at a new local-memory
+    cache instead. Returns the cache and a function that undoes this.
+    """
+    locmem = get_cache('django.core.cache.backends.locmem.LocMemCache')
+    saved = localcache.shared_cache.backend
+    localcache.shared_cache.backend = locmem
+
+    def restore():
+        localcache.shared_cache.backend = saved
+    return (locmem, restore)
+
+def queries_in(response):
+    """
+    The number of queries that PerfMiddleware reported for the response.
+    """
+    match = re.search(r'db;desc="(\d+) queries"', response.get('Server-Timing', ''))
+    return int(match.group(1)) if match else 0
+
+@skipUnless(os.environ.get('RUN_BENCH'), "set RUN_BENCH to run the benchmark")
+class Benchmark(TestCase):
+    """
+    Times each of the hot views through the test client, cold (with nothing
+    cached or stored) and warm (right after the same request), keeping the
+    best of RUN_BENCH_REPEAT tries of each, and checks what they send with
+    and without gzip.
+    """
+    def setUp(self):
+        self.users = int(os.environ.get('RUN_BENCH_USERS', 3))
+        self.years = int(os.environ.get('RUN_BENCH_YEARS', 1))
+        self.seed = int(os.environ.get('RUN_BENCH_SEED', 1))
+        self.repeat = int(os.environ.get('RUN_BENCH_REPEAT', 3))
+        (self.locmem, self.restore_cache) = use_locmem()
+        self.import_dir = tempfile.mkdtemp()
+
+        generate(self.users, self.years, self.seed)
+        self.user = User.objects.get(username='bench0')
+        self.other = User.objects.get(username='bench1')
+        self.assertTrue(self.client.login(username='bench0', password='pw'))
+
+    def tearDown(self):
+        self.restore_cache()
+        shutil.rmtree(self.import_dir)
+
+    def clear(self):
+        self.locmem.clear()
+        if isinstance(localcache.cache, localcache.LocalCache):
+            localcache.cache.entries.clear()
+        Aggregate.objects.all().delete()
+
+    def best(self, measure, prepare=None):
+        """
+        Returns the (milliseconds, queries) of the fastest of the tries of
+        measure, calling prepare (untimed) before each.
+        """
+        results = []
+        for i in range(self.repeat):
+            if prepare:
+                prepare()
+            start = time.time()
+            queries = measure()
+            results.append((1000 * (time.time() - start), queries))
+        return min(results)
+
+    def get(self, url):
+        def measure():
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.content) # the export is streamed
+            return queries_in(response)
+        return measure
+
+    def check(self, url, parse):
+        """
+        Passes the body of the page to parse, as sent plain and gzipped.
+        """
+        for gzip in (False, True):
+            if gzip:
+                response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+                body = GzipFile(fileobj=StringIO(response.content)).read()
+            else:
+                response = self.client.get(url)
+                self.assertFalse(response.has_header('Content-Encoding'))
+                body = response.content
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(body)
+            parse(body)
+
+    def page(self, body):
+        self.assertIn('</html>', body)
+
+    def view(self, name, url, parse=None):
+        cold = self.best(self.get(url), prepare=self.clear)
+        warm = self.best(self.get(url))
+        self.check(url, parse or self.page)
+        return (name, cold, warm)
+
+    def importing(self):
+        data = ''.join(exporter.json_array(exporter.export_rows(self.other)))
+        runs = Run.objects.filter(user=self.user)
+        before = runs.count()
+        last_id = runs.order_by('-id')[0].id
+        expected = before + Run.objects.filter(user=self.other).count()
+
+        def measure():
+            upload = StringIO(data)
+            upload.name = 'runs.json'
+            response = self.client.post('/bench0/import', {'data_file': upload})
+            self.assertEqual(response.status_code, 302)
+            with perf.collecting() as stats:
+                call_command('run_imports', once=True, stdout=StringIO())
+            return queries_in(response) + stats.get('db')
+
+        cold = self.best(measure, prepare=lambda: runs.filter(
+            id__gt=last_id).delete())
+        self.assertEqual(runs.count(), expected)
+        warm = self.best(measure) # the same runs again, all duplicates
+        self.assertEqual(runs.count(), expected)
+        return ('do_import', cold, warm)
+
+    def invalidating(self):
+        today = datetime.date.today()
+        first = today - datetime.timedelta(days=365 * self.years)
+
+        def measure():
+            with perf.collecting() as stats:
+                views.invalidate_cache(self.user, first, today)
+            return stats.get('db')
+
+        # cold has every aggregate of the user's pages stored to delete
+        cold = self.best(measure, prepare=lambda: (self.clear(),
+            self.client.get('/bench0/'), self.client.get('/bench0/history')))
+        warm = self.best(measure)
+        return ('invalidate_cache', cold, warm)
+
+    def report(self, rows):
+        lines = ["%-18s %10s %8s %10s %8s" % ('view', 'cold ms', 'queries',
+            'warm ms', 'queries')]
+        for (name, cold, warm) in rows:
+            lines.append("%-18s %10.1f %8d %10.1f %8d" % (name, cold[0], cold[1],
+                warm[0], warm[1]))
+        sys.stderr.write("\nBenchmark: %d users, %d years, seed %d, best of %d\n%s\n" %
+            (self.users, self.years, self.seed, self.repeat, "\n".join(lines)))
+
+        output = os.environ.get('RUN_BENCH_OUTPUT')
+        if output:
+            with open(output, 'w') as f:
+                f.write("view\tcold_ms\tcold_queries\twarm_ms\twarm_queries\n")
+                for (name, cold, warm) in rows:
+                    f.write("%s\t%.1f\t%d\t%.1f\t%d\n" % ((name,) + cold + warm))
+
+    def test_hot_views(self):
+        with self.settings(RUN_IMPORT_DIR=self.import_dir):
+            rows = [
+                self.view('index_user', '/bench0/'),
+                self.view('index_all', '/_all/'),
+                self.view('history_user', '/bench0/history'),
+                self.view('yield_user', '/bench0/yield'),
+                self.view('do_export', '/bench0/export', parse=json.loads),
+                self.importing(),
+                self.invalidating(),
+            ]
+        self.report(rows)
@@ -28,7 +28,10 @@ urlpatterns = patterns('run.views',
     url(r'^(?P<username>[^_](\w+))/profile/update$', 'userprofile_update'),
     url(r'^(?P<username>[^_](\w+))/profile/delete$', 'userprofile_delete'),
     url(r'^(?P<username>[^_](\w+))/import$', 'do_import'),
+    url(r'^(?P<username>[^_](\w+))/import/(?P<job_id>\d+)$', 'import_status'),
+    url(r'^(?P<username>[^_](\w+))/import/(?P<job_id>\d+)/progress$', 'import_progress'),
     url(r'^(?P<username>[^_](\w+))/export$', 'do_export'),
+    url(r'^(?P<username>[^_](\w+))/range$', 'range_user'),
     url(r'^(?P<username>[^_](\w+))/shoe/$', 'shoe_all'),
     url(r'^(?P<username>[^_](\w+))/shoe/add$', 'shoe_add'),
     url(r'^(?P<username>[^_](\w+))/shoe/remove/(?P<shoe_id>\d+)$', 'shoe_remove'),
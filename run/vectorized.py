@@ -0,0 +1,83 @@
+"""
+Grouped reductions over a user's daily summaries with NumPy, used to bucket
+long histories into weeks or months in one pass. Everything is done in
+integers (distances in thousandths of a mile) so the totals are exact.
+"""
+import decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from run.models import DailySummary
+
+INTEGER_COLUMNS = ('count', 'duration', 'calories', 'hr_duration', 'beat_seconds')
+DECIMAL_COLUMNS = ('distance', 'hr_distance', 'minimum', 'maximum')
+
+def available():
+    return numpy is not None
+
+def load_columns(summaries):
+    """
+    Loads the summaries as a dict of column arrays, plus the date ordinals.
+    """
+    fields = ('date',) + INTEGER_COLUMNS + DECIMAL_COLUMNS
+    rows = list(summaries.values_list(*fields))
+    columns = {'ordinal': numpy.fromiter((row[0].toordinal() for row in rows),
+        numpy.int64, len(rows))}
+    for (i, field) in enumerate(fields[1:]):
+        if field in DECIMAL_COLUMNS:
+            values = (int(round(row[i + 1] * 1000)) for row in rows)
+        else:
+            values = (row[i + 1] for row in rows)
+        columns[field] = numpy.fromiter(values, numpy.int64, len(rows))
+    return columns
+
+def bucket_summaries(summaries, periods):
+    """
+    Returns a dict mapping each (first_day, last_day) period to a list
+    holding one unsaved DailySummary with the totals of the summaries in
+    that period, or an empty list if there were none. The periods must be
+    sorted and must not overlap.
+    """
+    buckets = dict((period, []) for period in periods)
+    columns = load_columns(summaries)
+    if not len(columns['ordinal']):
+        return buckets
+
+    n = len(periods)
+    starts = numpy.array([first.toordinal() for (first, last) in periods])
+    ends = numpy.array([last.toordinal() for (first, last) in periods])
+    index = numpy.searchsorted(starts, columns['ordinal'], side='right') - 1
+    inside = (index >= 0) & (columns['ordinal'] <= ends[index.clip(0)])
+    index = index[inside]
+
+    def total(field):
+        # float64 sums of integers are exact up to 2**53
+        return numpy.bincount(index, weights=columns[field][inside],
+            minlength=n).round().astype(numpy.int64)
+
+    totals = dict((field, total(field)) for field in
+        INTEGER_COLUMNS + ('distance', 'hr_distance'))
+    minima = numpy.full(n, numpy.iinfo(numpy.int64).max, numpy.int64)
+    numpy.minimum.at(minima, index, columns['minimum'][inside])
+    maxima = numpy.zeros(n, numpy.int64)
+    numpy.maximum.at(maxima, index, columns['maximum'][inside])
+
+    for (i, period) in enumerate(periods):
+        if not totals['count'][i]:
+            continue
+        summary = DailySummary(date=period[0])
+        for field in INTEGER_COLUMNS:
+            setattr(summary, field, int(totals[field][i]))
+        summary.distance = thousandths(totals['distance'][i])
+        summary.hr_distance = thousandths(totals['hr_distance'][i])
+        summary.minimum = thousandths(minima[i])
+        summary.maximum = thousandths(maxima[i])
+        buckets[period].append(summary)
+
+    return buckets
+
+def thousandths(value):
+    return decimal.Decimal(int(value)) / 1000
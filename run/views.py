@@ -1,27 +1,34 @@
-import datetime, calendar, logging, random, json
-from datetime import date, time, timedelta
-from decimal import Decimal
+import datetime, calendar, logging, random, json, time
+from bisect import bisect_right
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 from urllib import urlencode
 
 from django.contrib import messages
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.models import User
-from django.core.cache import cache
 from django.core.mail import send_mail
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
 from django.db.models import Min
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, Http404
-from django.shortcuts import render_to_response, get_object_or_404
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest, Http404
+from django.shortcuts import get_object_or_404
 from django.template import RequestContext
+from django.utils.cache import patch_vary_headers
+from django.utils.formats import date_format
 from django.views.decorators.http import condition
 from django.views.decorators.cache import cache_control
 
 from django_recaptcha_field import create_form_subclass_with_recaptcha
 from recaptcha import RecaptchaClient
 
-from run.models import UserProfile, Shoe, Run, hms_to_time, Aggregate
+from run.models import UserProfile, Shoe, Run, hms_to_time, Aggregate, DailySummary, ImportJob
+from run import exporter, jobs, perf, recalc, vectorized
 from run.forms import RunForm, ShoeForm, UserForm, NewUserForm, UserProfileForm, ImportForm
+from run.localcache import cache # memcached, fronted by an optional per-process LRU
+from run.localcache import shared_cache
+from run.perf import render_to_response # timed
 
 BASE_URI = "http://get.theruns.in"
 MAIL_FROM_ADDR = "admin@theruns.in"
@@ -38,199 +45,394 @@ MONTH_ALL_AG_PREFIX = 'MONTH_ALL_AG'
 LM_PREFIX = 'LM'
 LM_ALL_PREFIX = 'LM_ALL'
 FIRST_PREFIX = 'FIRST'
+GEN_PREFIX = 'GEN'
+GEN_ALL_PREFIX = 'GEN_ALL'
+YIELD_PREFIX = 'YIELD'
+LOCK_PREFIX = 'LOCK'
+
+# cached in place of None, which the cache can't distinguish from a miss
+EMPTY = 'EMPTY'
+
+# single-flight recomputation of aggregates
+LOCK_TIMEOUT = 30 # seconds
+LOCK_WAIT = 0.05 # seconds
+LOCK_ATTEMPTS = 40
 
 ONE_DAY = timedelta(days=1)
 ONE_WEEK = timedelta(days=7)
 
-def ag_cache_key(prefix, user, date): 
+def generation_cache_key(user): 
     if user: 
-        return "%s_%d_%d_%d_%d" % (prefix, user.id, date.year, date.month, date.day)
+        return "%s_%d" % (GEN_PREFIX, user.id)
     else: 
-        return "%s_%d_%d_%d" % (prefix, date.year, date.month, date.day)
+        return GEN_ALL_PREFIX
+
+def get_generation(user): 
+    """
+    Every cached value derived from a user's runs (or from everyone's, if 
+    user is None) is keyed by the current generation number, so bumping it 
+    invalidates all of them at once. 
+    """
+    key = generation_cache_key(user)
+    generation = cache.get(key)
+    if generation is None: 
+        # start from the clock so an evicted counter never reuses old keys
+        start = int(time.time())
+        cache.add(key, start)
+        # the cache may keep nothing (e.g. memcached is down), in which case 
+        # no key is reused anyway
+        generation = cache.get(key, start)
+    return generation
+
+def bump_generation(user): 
+    key = generation_cache_key(user)
+    try: 
+        cache.incr(key)
+    except ValueError: 
+        cache.set(key, int(time.time()))
 
-def lm_cache_key(user):
+def ag_cache_key(prefix, user, date, generation): 
     if user: 
-        return "%s_%d" % (LM_PREFIX,user.id)
+        return "%s_%d_%d_%d_%d_%d" % (prefix, user.id, generation, 
+            date.year, date.month, date.day)
     else: 
-        return LM_ALL_PREFIX
-    
-def first_date_cache_key(userid):
-    return "%s_%d" % (FIRST_PREFIX, userid)
+        return "%s_%d_%d_%d_%d" % (prefix, generation, 
+            date.year, date.month, date.day)
 
-def aggregate_runs(user, first_day, last_day):
-    MAX_CONST = 1000000 # ought to be enough for anyone 
+def lm_cache_key(user, generation):
+    if user: 
+        return "%s_%d_%d" % (LM_PREFIX, user.id, generation)
+    else: 
+        return "%s_%d" % (LM_ALL_PREFIX, generation)
     
-    duration = 0
-    distance = 0
-    total_distance_in_meters = 0
-    hr_distance_in_meters = 0
-    hr_duration_in_seconds = 0
-    heartbeats = 0
-    calories = 0
-    minimum = MAX_CONST
-    maximum = 0
+def first_date_cache_key(userid, generation):
+    return "%s_%d_%d" % (FIRST_PREFIX, userid, generation)
+
+def yield_cache_key(userid, last_modified, today): 
+    return "%s_%d_%s_%d" % (YIELD_PREFIX, userid, 
+        last_modified.strftime("%Y%m%d%H%M%S%f"), today.toordinal())
+
+def summarize_days(user, first_day, last_day, summaries):
+    """
+    Builds an (unsaved) Aggregate from the given DailySummaries, which are 
+    assumed to fall between first_day and last_day. 
+    """
+    ag = Aggregate(user=user, first_date=first_day, last_date=last_day, 
+        distance=0, calories=0, minimum=0, maximum=0)
+
+    for summary in summaries: 
+        ag.add_summary(summary)
+    ag.update_derived()
+
+    return ag
 
+def summaries_in_range(user, first_day, last_day):
     if user: 
-        runs = (Run.objects.filter(user=user.id)
+        summaries = (DailySummary.objects.filter(user=user.id)
             .filter(date__gte=first_day).filter(date__lte=last_day))
-    else: # user == None means aggregate all users
-        runs = (Run.objects.all()
+    else: # user == None means the all-users daily totals
+        summaries = (DailySummary.objects.for_user(None)
             .filter(date__gte=first_day).filter(date__lte=last_day))
+    return summaries
 
-    for run in runs: 
-        duration += run.duration_in_seconds()
-        distance += run.distance
-        total_distance_in_meters += run.distance_in_meters()
-        calories += run.calories
-        if run.average_heart_rate:
-            hr_distance_in_meters += run.distance_in_meters()
-            hr_duration_in_seconds += run.duration_in_seconds()
-            heartbeats += run.heartbeats()
-        if run.distance < minimum: 
-            minimum = run.distance
-        if run.distance > maximum: 
-            maximum = run.distance
-
-    if minimum == MAX_CONST: 
-        minimum = 0
-
-    if duration > 0: 
-        speed = total_distance_in_meters / duration
-    else:
-        speed = None
-    
-    if len(runs) > 0: 
-        average = distance / len(runs)
+def aggregate_range(user, first_day, last_day): 
+    """
+    Returns an (unsaved) Aggregate for any range of days. This takes a 
+    constant number of lookups in the cumulative daily totals, regardless of 
+    the length of the range or the number of users. (The week and month 
+    series read every day of their span anyway, in aggregate_runs_by_period.) 
+    """
+    if user: 
+        totals = DailySummary.range_totals(user.id, first_day, last_day)
     else: 
-        average = 0
-        
-    if hr_duration_in_seconds > 0: 
-        beats_per_second = (heartbeats / hr_duration_in_seconds)
-        heart_rate = beats_per_second * 60
+        totals = DailySummary.range_totals(None, first_day, last_day)
+
+    if totals: 
+        summaries = [totals]
     else: 
-        heart_rate = None
-        beats_per_second = None
-        
-    efficiency = Run.compute_efficiency(hr_distance_in_meters, heartbeats)
-    if not efficiency > 0: 
-        efficiency = None
-        
-    ag = Aggregate()
-    ag.user = user
-    ag.distance = distance
-    ag.minimum = minimum
-    ag.maximum = maximum 
-    ag.average = average
-    ag.pace = Run.compute_pace(duration, distance)
-    ag.efficiency = efficiency
-    ag.speed = speed
-    ag.calories = calories
-    ag.first_date = first_day
-    ag.last_date = last_day
-    ag.heart_rate = heart_rate
-    ag.beats_per_second = beats_per_second
-
-    ag.save()
+        summaries = []
+    return summarize_days(user, first_day, last_day, summaries)
 
+def save_aggregate(ag): 
+    """
+    Saves a newly computed Aggregate, or returns the one for the same 
+    period that another request saved first. 
+    """
+    sid = transaction.savepoint()
+    try: 
+        ag.save()
+    except IntegrityError: 
+        transaction.savepoint_rollback(sid)
+        return Aggregate.objects.for_user(ag.user_id).get(first_date=ag.first_date, 
+            last_date=ag.last_date)
+    transaction.savepoint_commit(sid)
     return ag
+
+def aggregate_runs_by_period(user, periods, save=True): 
+    """
+    Aggregates runs for each of the given (first_day, last_day) periods, 
+    which must not overlap, using a single query over the whole span. 
+    Returns the Aggregates in the same order as the periods, saved unless 
+    save is False. 
+    """
+    if not periods: 
+        return []
+
+    ordered = sorted(periods)
+    summaries = summaries_in_range(user, ordered[0][0], 
+        max(last for (first, last) in ordered))
+
+    if vectorized.available(): 
+        buckets = vectorized.bucket_summaries(summaries, ordered)
+    else: 
+        starts = [first for (first, last) in ordered]
+        buckets = dict((period, []) for period in ordered)
+        for summary in summaries: 
+            i = bisect_right(starts, summary.date) - 1
+            if i >= 0 and summary.date <= ordered[i][1]: 
+                buckets[ordered[i]].append(summary)
+
+    ags = []
+    for (first, last) in periods: 
+        ag = summarize_days(user, first, last, buckets[(first, last)])
+        if save: 
+            ag = save_aggregate(ag)
+        ags.append(ag)
+    perf.count('aggregates', len(periods))
+
+    log.info("Aggregate DB MISS: %s (%d periods)" % (user, len(periods)))
+    return ags
     
-def get_aggregate_from_db(user, first_date, last_date):
+def invalidate_cache(user, date, last_date=None):
+    """
+    Deletes the stored aggregates covering date (or, if last_date is given, 
+    any day from date to last_date) for the user and for everyone, and bumps 
+    both generations so everything cached for them is ignored. 
+    """
+    if last_date is None: 
+        last_date = date
+
+    Aggregate.objects.filter(user=user.id,first_date__lte=last_date,
+        last_date__gte=date).delete()
+    Aggregate.objects.for_user(None).filter(first_date__lte=last_date,
+        last_date__gte=date).delete()
+
+    bump_generation(user)
+    bump_generation(None)
+
+def invalidate_days(user, days): 
+    """
+    Deletes the stored aggregates covering any of the given days, for the 
+    user and for everyone, along with the cached week and month aggregates 
+    for those days. Unlike invalidate_cache, the generations are left alone, 
+    so everything else that is cached stays valid. 
+    """
+    if not days: 
+        return
+
+    periods = set()
+    for day in days: 
+        periods.add(surrounding_week(day))
+        periods.add(surrounding_month(day))
+    for (u, week_prefix, month_prefix) in (
+            (user, WEEK_USER_AG_PREFIX, MONTH_USER_AG_PREFIX), 
+            (None, WEEK_ALL_AG_PREFIX, MONTH_ALL_AG_PREFIX)): 
+        if u: 
+            userid = u.id
+        else: 
+            userid = None
+        ags = Aggregate.objects.for_user(userid).filter(first_date__lte=max(days), 
+            last_date__gte=min(days))
+        for ag in ags: 
+            if any(ag.first_date <= day <= ag.last_date for day in days): 
+                ag.delete()
+
+        generation = get_generation(u)
+        keys = []
+        for (first, last) in periods: 
+            if (first, last) == surrounding_week(first): 
+                keys.append(ag_cache_key(week_prefix, u, first, generation))
+            else: 
+                keys.append(ag_cache_key(month_prefix, u, first, generation))
+        cache.delete_many(keys)
+        reset_last_modified(u)
+
+def recompute_for_profile(user, changed): 
+    """
+    Recomputes the runs affected by a change to the given profile inputs, 
+    and invalidates only the aggregates whose calorie totals moved. 
+    """
+    fields, only_heart_rate = recalc.affected_fields(changed)
+    if not fields: 
+        return
+    (count, deltas) = recalc.recalculate([user.id], fields, 
+        only_heart_rate=only_heart_rate)[user.id]
+    invalidate_days(user, deltas.keys())
+    reset_last_modified(user) # zones and heart rate percentages may differ
+    log.info("Recomputed %d runs of %s after changes to %s", count, user, 
+        ", ".join(sorted(changed)))
+
+def apply_run_delta(user, run, added): 
+    """
+    Adds (or removes) a single run to the stored week and month aggregates 
+    that cover its date, and refreshes their cache entries. Aggregates that 
+    can't be updated in place are deleted and recomputed on the next read. 
+    The rows are locked until the request's transaction ends, so concurrent 
+    saves (which all touch the all-users rows) apply their changes in turn 
+    instead of overwriting each other's. 
+    """
+    week = surrounding_week(run.date)
+    month = surrounding_month(run.date)
+    generation = get_generation(user)
     if user: 
-        ags = Aggregate.objects.filter(user=user.id, 
-            first_date=first_date, last_date=last_date)
+        userid = user.id
+        week_prefix, month_prefix = WEEK_USER_AG_PREFIX, MONTH_USER_AG_PREFIX
     else: 
-        ags = Aggregate.objects.filter(user=None, 
-            first_date=first_date, last_date=last_date)
-
-    if len(ags) == 1:
-        # log.debug("Aggregate DB HIT: %s" % ags[0])
-        return ags[0]
-    elif len(ags) == 0: 
-        ag = aggregate_runs(user, first_date, last_date)
-        log.info("Aggregate DB MISS: %s" % ag)
-        return ag
-    else: 
-        # FYI: this has happened at least once, but I'm not sure why. 
-        # It might be wise to just invalidate the cache and regenerate the 
-        # aggregates from the DB
-        raise Exception("Multiple aggregates for %s at %s - %s" % 
-            (user, first_date, last_date))
-            
-def invalidate_cache(user, date):
-    # invalidate user aggregates
-    ags = Aggregate.objects.filter(user=user.id,first_date__lte=date,
-        last_date__gte=date)
-    
-    week_keys = [ag_cache_key(WEEK_USER_AG_PREFIX,user,ag.first_date) for ag in ags]
-    log.info("Evicting %s from week_cache", cache.get_many(week_keys))
-    cache.delete_many(week_keys)
-    month_keys = [ag_cache_key(MONTH_USER_AG_PREFIX,user,ag.first_date) for ag in ags]
-    log.info("Evicting %s from month_cache", cache.get_many(month_keys))
-    cache.delete_many(month_keys)
+        userid = None
+        week_prefix, month_prefix = WEEK_ALL_AG_PREFIX, MONTH_ALL_AG_PREFIX
+
+    ags = (Aggregate.objects.for_user(userid).select_for_update()
+        .filter(first_date__lte=run.date, last_date__gte=run.date))
+    for ag in ags: 
+        period = (ag.first_date, ag.last_date)
+        if period == week: 
+            key = ag_cache_key(week_prefix, user, ag.first_date, generation)
+        elif period == month: 
+            key = ag_cache_key(month_prefix, user, ag.first_date, generation)
+        else: 
+            key = None
 
-    ags.delete()
+        if added: 
+            ag.add_run(run)
+            updated = True
+        else: 
+            updated = ag.remove_run(run)
+
+        if updated and key: 
+            ag.update_derived()
+            ag.save()
+            cache.set(key, ag)
+        else: 
+            ag.delete()
+            if key: 
+                cache.delete(key)
+
+def update_cache(run, added=True): 
+    """
+    Updates the aggregates and caches after run has been added or removed. 
+    """
+    user = run.user
+    apply_run_delta(user, run, added)
+    apply_run_delta(None, run, added)
 
     # invalidate first-date 
-    key = first_date_cache_key(user.id)
+    key = first_date_cache_key(user.id, get_generation(user))
     first_date = cache.get(key)
-    if first_date and first_date < date: 
+    if first_date == EMPTY or (first_date and first_date >= run.date): 
         cache.delete(key)
 
-    # clear user's lm date 
+    # clear user's lm date and the all-users lm date
     reset_last_modified(user)
+    reset_last_modified(None)
 
-    # invalidate _we aggregates
-    ags = Aggregate.objects.filter(user=None,first_date__lte=date,
-        last_date__gte=date)
-    
-    week_keys = [ag_cache_key(WEEK_ALL_AG_PREFIX,None,ag.first_date) for ag in ags]
-    log.info("Evicting %s from week_cache", cache.get_many(week_keys))
-    cache.delete_many(week_keys)
-    month_keys = [ag_cache_key(MONTH_ALL_AG_PREFIX,None,ag.first_date) for ag in ags]
-    log.info("Evicting %s from month_cache", cache.get_many(month_keys))
-    cache.delete_many(month_keys)
-
-    ags.delete()
-
-    # also reset the lm cache
-    key = lm_cache_key(None)
-    cache.delete(key)
-
-def get_aggregate_generic(prefix, user, first_date, last_date): 
-    key = ag_cache_key(prefix, user, first_date)
-    ag = cache.get(key)
-    if ag: 
-        # log.debug("Aggregate CACHE HIT: %s" % ag)
-        return ag
+def get_aggregates_from_db(user, periods, save=True): 
+    """
+    Fetches the stored Aggregates for the given periods with a single query, 
+    and computes the missing ones with a single pass over the runs (storing 
+    them unless save is False). 
+    """
+    if user: 
+        userid = user.id
     else: 
-        if user: 
-            username = user.username
+        userid = None
+
+    firsts = [first for (first, last) in periods]
+    ags = {}
+    duplicates = set()
+    for ag in Aggregate.objects.for_user(userid).filter(first_date__in=firsts): 
+        period = (ag.first_date, ag.last_date)
+        if period in ags: 
+            duplicates.add(period)
+        ags[period] = ag
+
+    for period in duplicates: 
+        # left behind by concurrent recomputes in databases created before 
+        # the unique constraints; throw them all away and start over
+        log.warning("Multiple aggregates for %s at %s - %s" % 
+            (user, period[0], period[1]))
+        Aggregate.objects.for_user(userid).filter(first_date=period[0], 
+            last_date=period[1]).delete()
+        del ags[period]
+
+    misses = [period for period in periods if period not in ags]
+    for ag in aggregate_runs_by_period(user, misses, save): 
+        ags[(ag.first_date, ag.last_date)] = ag
+
+    return [ags[period] for period in periods]
+
+def get_aggregates_generic(prefix, user, periods): 
+    """
+    Returns the Aggregates for a series of periods with one cache round-trip 
+    to read them, one batched DB read for any misses, and one to store them. 
+    """
+    generation = get_generation(user)
+    keys = [ag_cache_key(prefix, user, first_date, generation) 
+        for (first_date, last_date) in periods]
+    cached = cache.get_many(keys)
+    
+    ags = {}
+    misses = []
+    for (key, period) in zip(keys, periods): 
+        ag = cached.get(key)
+        if ag: 
+            ags[key] = ag
         else: 
-            username = None
-        
-        log.debug("Aggregate CACHE MISS: %s: %s - %s" % 
-            (username, first_date, last_date))
-        ag = get_aggregate_from_db(user, first_date, last_date)
-        
-        # # FIXME this should be done before putting the aggregates in the db
-        # ag.avg_min = ag.average - ag.minimum
-        # ag.max_avg = ag.maximum - ag.average
-        # ag.tot_max = ag.distance - ag.maximum
-        
-        cache.set(key, ag)
-        return ag
+            misses.append(period)
 
-def get_week_aggregate(user, first_date, last_date):
-    if user: 
-        return get_aggregate_generic(WEEK_USER_AG_PREFIX, user, first_date, last_date) 
-    else: 
-        return get_aggregate_generic(WEEK_ALL_AG_PREFIX, None, first_date, last_date) 
+    if misses: 
+        log.debug("Aggregate CACHE MISS: %s: %d of %d periods" % 
+            (user, len(misses), len(periods)))
+        ags.update(fill_aggregates(prefix, user, generation, misses))
+
+    return [ags[key] for key in keys]
 
-def get_month_aggregate(user, first_date, last_date):
+def fill_aggregates(prefix, user, generation, periods): 
+    """
+    Loads or computes the Aggregates for periods that missed the cache, and 
+    caches them. Only one process at a time fills a given user's aggregates; 
+    the others wait for it to finish and then read them from the cache, or 
+    if it takes too long (or the cache is down), compute their own without 
+    storing or caching them. 
+    Returns a dict of the Aggregates by cache key. 
+    """
+    keys = [ag_cache_key(prefix, user, first_date, generation) 
+        for (first_date, last_date) in periods]
     if user: 
-        return get_aggregate_generic(MONTH_USER_AG_PREFIX, user, first_date, last_date) 
+        lock = "%s_%s_%d" % (LOCK_PREFIX, prefix, user.id)
     else: 
-        return get_aggregate_generic(MONTH_ALL_AG_PREFIX, None, first_date, last_date) 
+        lock = "%s_%s" % (LOCK_PREFIX, prefix)
+
+    for attempt in range(LOCK_ATTEMPTS): 
+        if shared_cache.add(lock, 1, LOCK_TIMEOUT): 
+            try: 
+                fresh = dict(zip(keys, get_aggregates_from_db(user, periods)))
+                cache.set_many(fresh)
+                return fresh
+            finally: 
+                shared_cache.delete(lock)
+
+        time.sleep(LOCK_WAIT)
+        filled = cache.get_many(keys)
+        if len(filled) == len(keys): 
+            return filled
+        if shared_cache.get(lock) is None: 
+            # no one holds the lock, yet it couldn't be taken: the cache 
+            # is keeping nothing, so don't wait for it
+            break
+
+    # without the lock, storing them could race with whoever holds it
+    log.warning("Unable to take %s; computing without storing" % lock)
+    return dict(zip(keys, get_aggregates_from_db(user, periods, save=False)))
 
 
 def index_last_modified_user(request, user): 
@@ -246,11 +448,7 @@ def index_last_modified_user(request, user):
     if user and user.is_anonymous():
         return this_morning
     else: 
-        key = lm_cache_key(user)
-        lm = cache.get(key)
-        if not lm: 
-            lm = datetime.datetime.now()
-            cache.set(key, lm)
+        lm = get_last_modified(user)
 
         if request.user.is_authenticated():
             ll = request.user.last_login
@@ -276,10 +474,22 @@ def index_last_modified_any(request):
     this_morning = datetime.datetime.now().replace(hour=0,minute=0,second=0)
     return max(thismorning, lm)
 
+def get_last_modified(user): 
+    """
+    Last modification time of the user's runs (or anyone's, if user is None), 
+    as far as the cache knows. 
+    """
+    key = lm_cache_key(user, get_generation(user))
+    lm = cache.get(key)
+    if not lm: 
+        lm = datetime.datetime.now()
+        cache.add(key, lm)
+        lm = cache.get(key) or lm
+    return lm
+
 def reset_last_modified(user):
-    if user: 
-        key = lm_cache_key(user)
-        cache.delete(key)
+    key = lm_cache_key(user, get_generation(user))
+    cache.delete(key)
     
 def surrounding_week(start):
     last_monday = start - (ONE_DAY * start.weekday())
@@ -288,10 +498,14 @@ def surrounding_week(start):
 
 def get_aggregates_by_week(user, start, scale):
     def get_previous_week(i): 
-        last_monday, sunday = surrounding_week(start - i * ONE_WEEK)
-        return get_week_aggregate(user, last_monday, sunday)
+        return surrounding_week(start - i * ONE_WEEK)
 
-    return map(get_previous_week, range(scale))
+    if user: 
+        prefix = WEEK_USER_AG_PREFIX
+    else: 
+        prefix = WEEK_ALL_AG_PREFIX
+
+    return get_aggregates_generic(prefix, user, map(get_previous_week, range(scale)))
     
 def surrounding_month(start):
     first_of_the_month = start.replace(day=1)
@@ -310,10 +524,14 @@ def get_aggregates_by_month(user, start, scale):
         newmonth = remainder + 1
         newyear = start.year + quotient
         newdate = start.replace(month=newmonth, year=newyear, day=1)
-        first, last = surrounding_month(newdate)
-        return get_month_aggregate(user, first, last)
+        return surrounding_month(newdate)
     
-    return map(get_previous_month, range(scale))
+    if user: 
+        prefix = MONTH_USER_AG_PREFIX
+    else: 
+        prefix = MONTH_ALL_AG_PREFIX
+
+    return get_aggregates_generic(prefix, user, map(get_previous_month, range(scale)))
     
 def weeks_in_range(first, last):
     delta = first - last
@@ -341,12 +559,10 @@ def do_about(request):
 
 
 def __index_generic(request, user):
-    start = datetime.datetime.now()
-
     today = date.today()
     if 'today' in request.GET: 
         try: 
-            today = datetime.datetime.strptime(request.GET['today'], "%Y-%m-%d")
+            today = datetime.datetime.strptime(request.GET['today'], "%Y-%m-%d").date()
         except ValueError as e: 
             log.warn("Unable to parse date on index for user %s: %s", user, e)
     
@@ -361,14 +577,7 @@ def __index_generic(request, user):
 
     all_weeks = get_aggregates_by_week(user, today, scale)
     all_months = get_aggregates_by_month(user, today, scale)
-        
-    if user: 
-        username = user.username
-    else: 
-        username = None
 
-    log.debug('Index time for %s: %s', username, (datetime.datetime.now() - start))
-        
     context = {'theuser' : user,
         'this_week': all_weeks[0],
         'last_week': all_weeks[1], 
@@ -435,12 +644,14 @@ def index(request):
             args=[user.username]))
     
 def date_of_first_run(user):
-    key = first_date_cache_key(user.id)
+    key = first_date_cache_key(user.id, get_generation(user))
     date = cache.get(key)
-    if not date:
+    if date == EMPTY: 
+        return None
+    elif not date:
         date = Run.objects.filter(user=user.id).aggregate(Min('date'))['date__min']
         log.debug("First date not in cache: %s", date)
-        cache.set(key, date)
+        cache.add(key, date or EMPTY)
     return date
     
 @cache_control(must_revalidate=True)
@@ -450,7 +661,6 @@ def history_user(request, username):
     
     sameuser = (request.user == user)
     
-    start = datetime.datetime.now()
     today = date.today()
     first = date_of_first_run(user)
     if first is None: 
@@ -458,7 +668,7 @@ def history_user(request, username):
     
     if 'today' in request.GET: 
         try: 
-            today = datetime.datetime.strptime(request.GET['today'], "%Y-%m-%d")
+            today = datetime.datetime.strptime(request.GET['today'], "%Y-%m-%d").date()
         except ValueError as e: 
             log.warn("Unable to parse today's date: %s", e)
     
@@ -485,10 +695,7 @@ def history_user(request, username):
         other = 'week'
         format = 'n/y'
         all_ags = get_aggregates_by_month(user, today, month_scale)
-        
-    
-    log.debug('Index (all) time for %s: %s', user, (datetime.datetime.now() - start))
-    
+
     context = {'sameuser': sameuser,
         'all_ags': all_ags, 
         'by': by, 
@@ -499,6 +706,31 @@ def history_user(request, username):
     return render_to_response('run/all.html', context, 
         context_instance=RequestContext(request))
     
+def yield_buckets(user, today): 
+    """
+    Sorts the user's runs with a heart rate into five buckets by age (more 
+    than a year old, then 6-12, 3-6 and 1-3 months, then the last month) 
+    with a single query. Each run is a [speed, efficiency, heart rate, pace, 
+    date] list. 
+    """
+    one_month = 4 * ONE_WEEK
+    boundaries = [today - (12 * one_month), today - (6 * one_month), 
+        today - (3 * one_month), today - one_month]
+    buckets = [[] for i in range(len(boundaries) + 1)]
+
+    runs = (Run.objects.filter(user=user.id,average_heart_rate__gt=0)
+        .order_by('date').values_list('date', 'speed', 'efficiency', 
+            'average_heart_rate', 'pace'))
+    for (day, speed, efficiency, hr, pace) in runs: 
+        buckets[bisect_right(boundaries, day)].append([rounded(speed), 
+            rounded(efficiency), hr, pace, date_format(day)])
+    return buckets
+
+def rounded(value, places=Decimal('0.001')): 
+    if value is None: 
+        return None
+    return float(Decimal(str(value)).quantize(places, rounding=ROUND_HALF_UP))
+
 @cache_control(must_revalidate=True)
 @condition(etag_func=None,last_modified_func=index_last_modified_username)
 def yield_user(request, username):
@@ -506,25 +738,14 @@ def yield_user(request, username):
     sameuser = (request.user == user)
     
     today = date.today()
-    one_month = 4 * ONE_WEEK
-    date_1 = today - one_month
-    date_2 = today - (3 * one_month) 
-    date_3 = today - (6 * one_month) 
-    date_4 = today - (12 * one_month) 
-    
-    all_runs = Run.objects.filter(user=user.id,average_heart_rate__gt=0)
-    runs_5 = all_runs.filter(date__gte=date_1)
-    runs_4 = all_runs.filter(date__lt=date_1,date__gte=date_2)
-    runs_3 = all_runs.filter(date__lt=date_2,date__gte=date_3)
-    runs_2 = all_runs.filter(date__lt=date_3,date__gte=date_4)
-    runs_1 = all_runs.filter(date__lt=date_4)
+    key = yield_cache_key(user.id, get_last_modified(user), today)
+    payload = cache.get(key)
+    if payload is None: 
+        payload = json.dumps(yield_buckets(user, today), separators=(',', ':'))
+        cache.add(key, payload)
     
     context = { 'sameuser': sameuser,
-        'runs_1': runs_1,
-        'runs_2': runs_2,
-        'runs_3': runs_3,
-        'runs_4': runs_4,
-        'runs_5': runs_5,
+        'payload': payload,
     }
 
     return render_to_response('run/yield.html', context, 
@@ -622,51 +843,84 @@ def do_import(request, username):
                 runs = form.cleaned_data['data_file']
                 
                 # delete existing runs if the user really wants to
-                if erase and really: 
-                    existing = Run.objects.filter(user=user.id)
-                    existing.delete()
-                elif erase or really: 
+                if (erase or really) and not (erase and really): 
                     messages.error(request, "Data not imported: should existing runs be erased?")
                     
-                for run in runs: 
-                    run.user = user
-                    run.set_zone()
-                    if not run.calories: 
-                        run.set_calories()
-                    log.debug("Importing run %s", run)
-                    run.save()
-                    
-                    invalidate_cache(user, run.date)
-                    
-                messages.success(request, "Data imported successfully.")
-                return HttpResponseRedirect(reverse('run.views.userprofile', args=[user.username]))
+                # the upload is only checked to be a JSON list here; the
+                # run_imports worker parses and imports it
+                job = jobs.enqueue_import(user, runs.data_file, 
+                    erase=(erase and really))
+                return HttpResponseRedirect(reverse('run.views.import_status', 
+                    args=[user.username, job.id]))
         else:
             form = ImportForm()
     
         return render_to_response('run/import.html', {'form': form},
             context_instance=RequestContext(request))
 
+def import_status(request, username, job_id):
+    if not is_authorized(request, username): 
+        return redirect_to_login(request)
+    job = get_object_or_404(ImportJob, id=job_id, user=request.user.id)
+    # the message may quote the file, so keep it from closing the script
+    progress = json.dumps(job.progress()).replace('</', '<\\/')
+    return render_to_response('run/import_status.html', 
+        {'job': job, 'progress': progress}, 
+        context_instance=RequestContext(request))
+
+@cache_control(no_cache=True)
+def import_progress(request, username, job_id):
+    if not is_authorized(request, username): 
+        return HttpResponseForbidden()
+    job = get_object_or_404(ImportJob, id=job_id, user=request.user.id)
+    return HttpResponse(json.dumps(job.progress()), mimetype='application/json')
+
+def range_user(request, username): 
+    """
+    The user's totals for any range of days, from ?first=YYYY-MM-DD to 
+    &last=YYYY-MM-DD inclusive, as JSON. 
+    """
+    if not is_authorized(request, username): 
+        return HttpResponseForbidden()
+    try: 
+        (first, last) = [datetime.datetime.strptime(request.GET[name], 
+            "%Y-%m-%d").date() for name in ('first', 'last')]
+    except (KeyError, ValueError): 
+        return HttpResponseBadRequest("first and last must be dates (YYYY-MM-DD)")
+    if first > last: 
+        return HttpResponseBadRequest("first must not be after last")
+
+    ag = aggregate_range(request.user, first, last)
+    totals = {'first': str(first), 'last': str(last), 'count': ag.count, 
+        'duration': ag.duration, 'calories': ag.calories, 'pace': ag.pace}
+    for field in ('distance', 'minimum', 'maximum', 'average', 'speed', 
+            'efficiency', 'heart_rate'): 
+        value = getattr(ag, field)
+        totals[field] = None if value is None else float(value)
+    return HttpResponse(json.dumps(totals), mimetype='application/json')
+
 def do_export(request, username):
     user = request.user
     if not is_authorized(request, username):
         return redirect_to_login(request)
     else:
+        format = request.GET.get('format', 'json')
+        if format not in exporter.FORMATS: 
+            raise Http404
+        (serialize, mimetype) = exporter.FORMATS[format]
         
-        def serialize_run(run):
-            return {'date' : str(run.date),
-                'duration' : run.duration_in_seconds(),
-                'distance' : int(run.distance_in_meters()),
-                'average_heart_rate' : run.average_heart_rate,
-                'calories' : run.calories}
-                
-        def serialize_all_runs(runs):
-            acc = []
-            for run in runs:
-                acc.append(serialize_run(run))
-            return acc
-            
-        return HttpResponse(json.dumps(serialize_all_runs(Run.objects.filter(user=user.id).order_by('-date'))),
-            mimetype="application/json")
+        # the content is an iterator, so it is sent as it is generated; the 
+        # middleware would buffer it to gzip it, so that is done here too,
+        # and it closes the connection it reads with (see exporter.closing)
+        content = serialize(exporter.export_rows(user))
+        compress = exporter.accepts_gzip(request)
+        if compress: 
+            content = exporter.gzipped(content)
+        response = HttpResponse(exporter.closing(content), mimetype=mimetype)
+        if compress: 
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
     
     
 def password_reset_start(request):
@@ -882,6 +1136,7 @@ def userprofile_update(request, username):
     user = request.user
     profile = user.get_profile()
     if request.method == 'POST': 
+        inputs = recalc.profile_inputs(profile)
         uform = UserForm(request.POST, instance=user)
         pform = UserProfileForm(request.POST, instance=profile)
         if uform.is_valid() and pform.is_valid():
@@ -891,6 +1146,11 @@ def userprofile_update(request, username):
             uform.save()
             pform.save()
             reset_last_modified(user)
+
+            changed = recalc.changed_inputs(inputs, profile)
+            if changed: 
+                # committed with the profile, for run_imports to pick up
+                jobs.enqueue_recalc(user, changed)
             
             messages.success(request, "Profile updated successfully.")
             log.info("Updated profile for %s: %s", user, user.get_profile())
@@ -978,11 +1238,13 @@ def run_add(request, username):
             run = form.instance
             # run.date = form.cleaned_data['date']
             # run.duration = form.cleaned_data['duration']
-            run.set_calories() 
-            run.set_zone()
+            profile = run.user.get_profile()
+            run.set_calories(profile) 
+            run.set_zone(profile)
+            run.set_metrics(profile) # so saving doesn't look up the profile again
             form.save()
             
-            invalidate_cache(user, form.cleaned_data['date'])
+            update_cache(run)
             shoe = form.cleaned_data['shoe']
 
             if shoe: 
@@ -1034,7 +1296,7 @@ def run_remove(request, username, run_id):
     log.info('Deleting run for %s: %s', user, run)
     run.delete()
     
-    invalidate_cache(run.user, run.date)
+    update_cache(run, added=False)
     
     messages.success(request, "Deleted run.")
 
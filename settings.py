@@ -99,7 +99,8 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
-    'django.middleware.gzip.GZipMiddleware',
+    'run.perf.PerfMiddleware',
+    'run.exporter.GZipMiddleware', # leaves the streamed exports to gzip themselves
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -160,6 +161,16 @@ CACHES = {
     }
 }
 
+# Optional per-process LRU in front of the default cache for hot aggregates 
+# and last-modified times (see run/localcache.py). Off by default: with it 
+# on, a process may serve a value for up to TIMEOUT seconds after another 
+# process has changed it. Uncomment to turn it on. 
+# RUN_LOCAL_CACHE = {
+#     'MAX_ENTRIES': 500,
+#     'TIMEOUT': 5,           # seconds an entry may be served locally
+#     'CHECK_INTERVAL': 1,    # seconds between shared version checks
+# }
+
 SEND_BROKEN_LINK_EMAILS = True
 
 # EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -221,3 +232,9 @@ LOGGING = {
     }
 }
 
+
+# uploaded imports wait here for the run_imports command
+RUN_IMPORT_DIR = BASE_DIR + 'fit/imports/'
+
+# requests that take longer are logged as warnings by run.perf.PerfMiddleware
+RUN_PERF_BUDGET_MS = 500
@@ -3,3 +3,5 @@
 . /home/iwehrman/fit_env/bin/activate
 
 python manage.py run_gunicorn 127.0.0.1:1337 --access-logfile=/home/iwehrman/fit/access.log --error-logfile=/home/iwehrman/fit/error.log --pid=/home/iwehrman/fit/gunicorn.pid -D
+nohup python manage.py run_imports >> /home/iwehrman/fit/run_imports.log 2>&1 &
+echo $! > /home/iwehrman/fit/run_imports.pid